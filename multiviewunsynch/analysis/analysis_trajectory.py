@@ -3,17 +3,16 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import numpy as np
-import pickle
 import tools.visualization as vis
 from datetime import datetime
 from analysis.compare_gt import align_gt
 from reconstruction import synchronization as sync
+from reconstruction.common import load_scene
 
 
 # Load trajectories
 data_file = ''
-with open(data_file, 'rb') as file:
-    flight = pickle.load(file)
+flight = load_scene(data_file)
 
 # Analysis
 
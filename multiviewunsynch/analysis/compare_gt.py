@@ -3,11 +3,11 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import numpy as np
-import pickle
 from scipy.optimize import least_squares
 from tools import ransac, util
 import tools.visualization as vis
 from thirdparty import transformation
+from reconstruction.common import load_scene
 
 
 def estimate_M(data,param=None):
@@ -156,8 +156,7 @@ if __name__ == "__main__":
 
     # Load the reconstructed trajectory
     reconst_path = ''
-    with open(reconst_path, 'rb') as file:
-        flight = pickle.load(file)
+    flight = load_scene(reconst_path)
 
     # Load the ground truth data
     gt_path = ''
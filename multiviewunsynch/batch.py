@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Reconstruction of many flights in a process pool
+#
+# Usage: python batch.py <config.json> [<config.json> ...] [--workers N] [--threads N] [--summary summary.csv]
+#
+# Each flight is reconstructed headless by a worker, and the output of each flight is written to "path_output" + ".log".
+# Calibration files are parsed once and shared with all workers. The number of BLAS threads of each worker is limited,
+# by default to the number of CPUs divided by the number of workers. Settings that start processes or threads of their own
+# ("ba_processes", "ba_threads", "spline_workers") are turned off, so each flight runs in its worker only.
+# A summary table is printed and written as csv.
+
+import argparse
+import os
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconstruct many flights in a process pool')
+    parser.add_argument('configs', nargs='+', help='config files of the flights')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=None, help='number of BLAS threads of each worker')
+    parser.add_argument('--summary', default='summary.csv', help='path of the summary table')
+    args = parser.parse_args()
+
+    # BLAS reads the number of threads when numpy is imported, so this has to happen first. Workers inherit the environment
+    num_workers = max(1, min(args.workers, len(args.configs)))
+    num_threads = str(args.threads or max(1, os.cpu_count() // num_workers))
+    for key in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        if args.threads or key not in os.environ:
+            os.environ[key] = num_threads
+
+import contextlib
+import csv
+import json
+import numpy as np
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from reconstruction import common
+from reconstruction.pipeline import Pipeline
+
+_worker = {}
+
+# Each flight is reconstructed in a single process, since the pool already runs one flight per worker
+_settings = {'ba_processes': 0, 'ba_threads': 0, 'spline_workers': 0}
+
+
+def init_worker(calibrations):
+    common.calibrations.update(calibrations)
+    _worker['pipeline'] = Pipeline(headless=True)
+
+
+def summary_row(path_config, status='ok'):
+    '''
+    Row of the summary of a flight without results
+    '''
+
+    return {'config': path_config, 'status': status, 'runtime': np.nan, 'cameras': '', 'detections': 0,
+            'error_mean': np.nan, 'error_median': np.nan, 'gt_error_mean': np.nan, 'gt_error_median': np.nan, 'output': ''}
+
+
+def reconstruct(path_config):
+    '''
+    Reconstruct one flight and return its row of the summary
+    '''
+
+    row = summary_row(path_config)
+
+    start = time.perf_counter()
+    try:
+        with open(path_config, 'r') as file:
+            row['output'] = json.load(file)['settings']['path_output']
+        with open(row['output'] + '.log', 'w') as log, contextlib.redirect_stdout(log):
+            flight = _worker['pipeline'].run(path_config, settings=_settings)
+    except Exception as e:
+        row['status'] = 'failed: {}'.format(repr(e))
+        row['runtime'] = time.perf_counter() - start
+        return row
+    row['runtime'] = time.perf_counter() - start
+
+    # Reprojection errors of the reconstructed cameras in pixels, and distances to the ground truth if it was aligned
+    error = np.concatenate([flight.error_cam(i) for i in flight.sequence])
+    row['cameras'] = '{}/{}'.format(len(flight.sequence), flight.numCam)
+    row['detections'] = len(error)
+    if len(error):
+        row['error_mean'], row['error_median'] = np.mean(error), np.median(error)
+    if flight.out and 'error' in flight.out:
+        row['gt_error_mean'], row['gt_error_median'] = np.mean(flight.out['error']), np.median(flight.out['error'])
+
+    return row
+
+
+def write_summary(path, rows):
+    '''
+    Print the summary table and write it as csv
+    '''
+
+    keys = list(rows[0].keys())
+    table = [keys] + [['{:.4g}'.format(row[key]) if isinstance(row[key], float) else str(row[key]) for key in keys] for row in rows]
+    width = [max(len(line[i]) for line in table) for i in range(len(keys))]
+    for line in table:
+        print('  '.join(value.ljust(width[i]) for i, value in enumerate(line)))
+
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=keys)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    # Parse all calibration files once, workers get a copy
+    for path_config in args.configs:
+        with open(path_config, 'r') as file:
+            for path in json.load(file)['necessary inputs']['path_cameras']:
+                common.load_calibration(path)
+
+    print('Reconstructing {} flights with {} workers and {} BLAS threads each\n'.format(len(args.configs), num_workers, num_threads))
+    start = time.perf_counter()
+    rows = [None] * len(args.configs)
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=(common.calibrations,)) as pool:
+        futures = {pool.submit(reconstruct, path): i for i, path in enumerate(args.configs)}
+        for num, future in enumerate(as_completed(futures)):
+            i = futures[future]
+            # A worker that dies, e.g. out of memory, breaks the pool and fails its flight and all flights not finished yet
+            try:
+                rows[i] = future.result()
+            except Exception as e:
+                rows[i] = summary_row(args.configs[i], status='failed: {}'.format(repr(e)))
+            print('[{}/{}] {}: {} in {:.1f} s'.format(num+1, len(rows), rows[i]['config'], rows[i]['status'], rows[i]['runtime']))
+
+    print('\nTotal time: {:.1f} s\n'.format(time.perf_counter() - start))
+    write_summary(args.summary, rows)
@@ -1,41 +1,25 @@
 import pickle
 #serialization or flattening 
-import numpy as np
 import simplekml
 from tools import visualization as vis
-import cv2
+from tools import smoothing
+from tools import result
 
 kml = simplekml.Kml()
 
-with open('result_dataset4.pkl', 'rb') as f:
-    data = pickle.load(f)
-
-trajectory = data.traj
-x,y,z = trajectory[1], trajectory[2], trajectory[3]
-
-# vis.show_trajectory_3D(data.traj[1:],line=False)
-
-kf = cv2.KalmanFilter(dynamParams = 3, measureParams=3)
-kf.controlMatrix = np.array([[1,0,0], [0,1,0], [0,0,1]], np.float32) #B
-kf.measurementMatrix = np.array([[1,0,0], [0,1,0], [0,0,1]], np.float32) #H
-kf.measurementNoiseCov = np.array([[1,0,0], [0,1,0], [0,0,1]], np.float32) * 2.5 #R
-kf.processNoiseCov = np.array([[1,0,0], [0,1,0], [0,0,1]], np.float32) *0.1 #Q
-kf.transitionMatrix = np.array([[1,0,0], [0,1,0], [0,0,1]], np.float32) #A
-
-def predict(x, y, z):
-    measured = np.array([[np.float32(x)], [np.float32(y)], [np.float32(z)]])
-    kf.correct(measured)
-    predicted = kf.predict()
-    x,y,z = predicted[0],predicted[1], predicted[2]
-    return x,y,z
-
-for i in range(len(x)):
-    predx,predy,predz = predict(x[i],y[i],z[i])
-    x = np.append(x, predx)
-    y = np.append(y, predy)
-    z = np.append(z, predz)
-
-predTraj = np.array([x,y,z], np.float32)
+# Either a pickled scene or a result file (.npz), of which only the trajectory and the settings are read
+path_result = 'result_dataset4.pkl'
+if path_result.endswith('.npz'):
+    with result.load_result(path_result) as data:
+        traj, settings = data['traj'], data.settings()
+else:
+    with open(path_result, 'rb') as f:
+        data = pickle.load(f)
+    traj, settings = data.traj, data.settings
+
+# Smooth the trajectory with a Kalman filter and an RTS smoother
+predTraj = smoothing.smooth_from_settings(traj, settings)[1:]
+x,y,z = predTraj
 
 vis.show_trajectory_3D(predTraj,line=False)
 
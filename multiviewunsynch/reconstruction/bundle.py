@@ -0,0 +1,594 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Structures shared by the bundle adjustment of a Scene
+import multiprocessing
+import numpy as np
+import os
+import pickle
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy.sparse import csr_matrix, csc_matrix, coo_matrix, vstack, find
+from tools import util
+
+
+# Thread and process pools are kept alive between BA calls, one per number of workers
+_thread_pools = {}
+_process_pools = {}
+
+
+def thread_pool(num_threads):
+    '''
+    Return a persistent pool of threads for the computation of errors
+    '''
+
+    if num_threads not in _thread_pools:
+        _thread_pools[num_threads] = ThreadPoolExecutor(max_workers=num_threads)
+    return _thread_pools[num_threads]
+
+
+def process_pool(num_processes):
+    '''
+    Return a persistent pool of processes, shared by the parallel Jacobian and the parallel spline fitting
+
+    Workers are started by a fork server, or spawned, so that they don't inherit the threads and locks of this process
+    '''
+
+    if num_processes not in _process_pools:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _process_pools[num_processes] = ProcessPoolExecutor(max_workers=num_processes, mp_context=multiprocessing.get_context(method))
+    return _process_pools[num_processes]
+
+
+def group_columns(structure, seed=0):
+    '''
+    Group the columns of a sparse matrix such that the columns of a group have no row in common
+
+    Columns are visited in a random order given by seed and assigned greedily, as least_squares does with jac_sparsity,
+    so that the groups and therefore the finite differences are identical
+    '''
+
+    structure = csc_matrix(structure)
+    m, n = structure.shape
+    order = np.random.RandomState(seed).permutation(n)
+    rows = [structure.indices[structure.indptr[j]:structure.indptr[j+1]] for j in order]
+
+    groups = np.full(n, -1)
+    remaining, group = list(range(n)), 0
+    while remaining:
+        union = np.zeros(m, dtype=bool)
+        rest = []
+        for j in remaining:
+            if union[rows[j]].any():
+                rest.append(j)
+            else:
+                union[rows[j]] = True
+                groups[j] = group
+        remaining, group = rest, group + 1
+
+    out = np.empty(n, dtype=int)
+    out[order] = groups
+    return out
+
+
+class BALayout:
+    """
+    Layout of a bundle adjustment problem with multiple splines
+
+    The layout describes how the parameters are packed into the model vector and which parameters
+    each residual depends on (the Jacobian sparsity). It is cached by the Scene and reused by
+    consecutive BA calls.
+
+    The layout is only valid for a fixed set of cameras and fixed spline knots. Detections are
+    tracked per camera, so that removing detections only drops the corresponding rows.
+
+    Members
+    -------
+    sequence : cameras in the order they appear in the model
+    idx_spline : start and end of each spline in the spline part of the model
+    blocks : sparsity rows of each camera, together with the detections they were built for
+    motion : sparsity rows of the motion regularization
+
+    Methods
+    -------
+    matches: check if the layout can be used for a BA call
+    update: bring the sparsity of each camera up to date with its detections
+    remove_detections: drop the rows of removed detections
+    sparsity: stack the rows into the Jacobian sparsity of the full problem
+    """
+
+    def __init__(self, sequence, num_camParam, spline, rs=False, opt_sync=True, motion_reg=False, near=3):
+        self.sequence = list(sequence)
+        self.numCam = len(self.sequence)
+        self.num_camParam = num_camParam
+        self.rs = rs
+        self.opt_sync = opt_sync
+        self.motion_reg = motion_reg
+        self.near = near
+
+        # Knots and intervals that the layout was built for
+        self.knots = [tck[0].copy() for tck in spline['tck']]
+        self.interval = spline['int'].copy()
+
+        # Reorganize splines into 1D and record indices of each spline
+        num_coeff = np.array([len(tck[1][0]) for tck in spline['tck']], dtype=int) * 3
+        end = np.cumsum(num_coeff)
+        self.idx_spline = np.vstack((end - num_coeff, end))
+        self.num_other = self.numCam * (3 + num_camParam)
+        self.idx_spline_sum = self.idx_spline + self.num_other
+        self.num_param = self.num_other + (end[-1] if len(end) else 0)
+
+        self.blocks = {}
+        self.motion = None
+
+
+    def matches(self, sequence, num_camParam, spline, rs=False, opt_sync=True, motion_reg=False):
+        '''
+        Check whether the layout was built for the given cameras, settings and spline knots
+        '''
+
+        if list(sequence) != self.sequence or num_camParam != self.num_camParam:
+            return False
+        if (rs, opt_sync, motion_reg) != (self.rs, self.opt_sync, self.motion_reg):
+            return False
+        if len(spline['tck']) != len(self.knots) or not np.array_equal(spline['int'], self.interval):
+            return False
+
+        return all(np.array_equal(tck[0], knot) for tck, knot in zip(spline['tck'], self.knots))
+
+
+    def update(self, scene):
+        '''
+        Rebuild the sparsity rows of cameras whose detections, visibility or nearest knots have changed
+
+        Rows of the motion regularization are built once, since they only depend on the knots
+        '''
+
+        for i in range(self.numCam):
+            cam_id = self.sequence[i]
+            scene.detection_to_global(cam_id)
+            timestamp = scene.detections_global[cam_id][0]
+            _, visible = util.sampling(timestamp, self.interval, belong=True)
+            nearest = self._nearest_knots(timestamp, visible - 1)
+
+            block = self.blocks.get(cam_id)
+            if block is None or not np.array_equal(block['frame'], scene.detections[cam_id][0]) \
+                             or not np.array_equal(block['nearest'], nearest):
+                self.blocks[cam_id] = {'frame': scene.detections[cam_id][0].copy(),
+                                       'nearest': nearest,
+                                       'jac': self._jac_cam(i, visible - 1, nearest)}
+
+        if self.motion_reg and self.motion is None:
+            self.motion = self._jac_motion(scene.spline_to_traj()[0])
+
+
+    def remove_detections(self, cam_id, mask):
+        '''
+        Keep only the rows of the detections selected by mask
+
+        The mask must refer to the detections the rows were built for, otherwise the rows are dropped
+        '''
+
+        block = self.blocks.get(cam_id)
+        if block is None:
+            return
+
+        if len(mask) == len(block['frame']):
+            self.blocks[cam_id] = {'frame': block['frame'][mask],
+                                   'nearest': block['nearest'][mask],
+                                   'jac': block['jac'][np.flatnonzero(mask)]}
+        else:
+            del self.blocks[cam_id]
+
+
+    def sparsity(self):
+        '''
+        Jacobian sparsity of the full problem
+
+        Residuals of each camera are ordered as all x errors followed by all y errors
+        '''
+
+        jac = []
+        for cam_id in self.sequence:
+            jac += [self.blocks[cam_id]['jac']] * 2
+        if self.motion_reg:
+            jac.append(self.motion)
+
+        return vstack(jac, format='csr')
+
+
+    def _nearest_knots(self, timestamp, spline_id):
+        '''
+        Indices of the nearest knots of each timestamp in its spline, -1 if it belongs to no spline
+
+        The nearest knots are consecutive, so they are located by the midpoints between knots that
+        are a window apart. Ties between a selected and an excluded knot (e.g. at repeated end knots)
+        are resolved by sorting the distances, which may select knots that are not consecutive.
+        '''
+
+        nearest = -np.ones((len(timestamp), self.near), dtype=int)
+        for s in range(len(self.knots)):
+            row = np.flatnonzero(spline_id == s)
+            knot = self.knots[s][2:-2]
+            if len(knot) <= self.near:
+                nearest[row, :len(knot)] = np.arange(len(knot))
+                continue
+
+            t = timestamp[row]
+            mid = (knot[:-self.near] + knot[self.near:]) / 2
+            start = np.searchsorted(mid, t)
+            nearest[row] = start[:, None] + np.arange(self.near)
+
+            dist_in = np.maximum(abs(t - knot[start]), abs(t - knot[start+self.near-1]))
+            dist_before = np.where(start > 0, abs(t - knot[np.maximum(start-1, 0)]), np.inf)
+            dist_after = np.where(start+self.near < len(knot), abs(t - knot[np.minimum(start+self.near, len(knot)-1)]), np.inf)
+            for j in row[dist_in == np.minimum(dist_before, dist_after)]:
+                nearest[j] = np.argsort(abs(knot-timestamp[j]))[:self.near]
+
+        return nearest
+
+
+    def _knot_columns(self, spline_id, nearest):
+        '''
+        Columns of the nearest spline coefficients in x, y and z for each row that belongs to a spline
+        '''
+
+        rows, cols = [np.empty(0, dtype=int)], [np.empty(0, dtype=int)]
+        for s in range(len(self.knots)):
+            row = np.flatnonzero(spline_id == s)
+            if not len(row):
+                continue
+
+            num_knot = len(self.knots[s]) - 4
+            knot_idx = nearest[row]
+            valid = np.tile(knot_idx >= 0, 3)
+            knot_idx = np.hstack((knot_idx, knot_idx + num_knot, knot_idx + 2*num_knot))
+
+            rows.append(np.repeat(row, knot_idx.shape[1]).reshape(knot_idx.shape)[valid])
+            cols.append((knot_idx + self.idx_spline_sum[0, s])[valid])
+
+        return np.concatenate(rows), np.concatenate(cols)
+
+
+    def _jac_cam(self, i, spline_id, nearest):
+        '''
+        Sparsity rows of a single camera, one row per detection
+
+        Detections that don't belong to any spline don't depend on any parameter
+        '''
+
+        numCam, num_camParam = self.numCam, self.num_camParam
+
+        # alpha, beta, rolling shutter and camera parameters
+        fixed = []
+        if self.opt_sync:
+            fixed += [i, i+numCam]
+        if self.rs:
+            fixed.append(i+numCam*2)
+        start = 3*numCam + i*num_camParam
+        fixed = np.concatenate((fixed, np.arange(start, start+num_camParam))).astype(int)
+
+        row_vis = np.flatnonzero(spline_id >= 0)
+        rows_fixed = np.repeat(row_vis, len(fixed))
+        cols_fixed = np.tile(fixed, len(row_vis))
+
+        # spline parameters
+        rows_spline, cols_spline = self._knot_columns(spline_id, nearest)
+
+        rows = np.concatenate((rows_fixed, rows_spline))
+        cols = np.concatenate((cols_fixed, cols_spline))
+        return csr_matrix((np.ones(len(rows), dtype=int), (rows, cols)), shape=(len(spline_id), self.num_param))
+
+
+    def _jac_motion(self, timestamp):
+        '''
+        Sparsity rows of the motion regularization, one row per sampled 3D point
+        '''
+
+        interval = self.interval
+        spline_id = np.searchsorted(interval[0], timestamp, side='right') - 1
+        spline_id[timestamp > interval[1, np.maximum(spline_id, 0)]] = -1
+
+        rows, cols = self._knot_columns(spline_id, self._nearest_knots(timestamp, spline_id))
+        return csr_matrix((np.ones(len(rows), dtype=int), (rows, cols)), shape=(len(timestamp), self.num_param))
+
+
+class ParamBlocks:
+    """
+    Parameters of a bundle adjustment problem stored in a single contiguous buffer
+
+    Each block is a view into the buffer, so writing a model vector updates all blocks at once
+    and consumers can hold on to the views without unpacking the vector.
+
+    Members
+    -------
+    x : the buffer, ordered as alpha, beta, rs, camera parameters and then splines or trajectory
+    alpha, beta, rs : views of length numCam
+    cam : view of shape (numCam, num_camParam), one row per camera
+    spline : list of views of shape (3, n), the coefficients of each spline in x, y and z
+    traj : view of shape (3, N), the discrete trajectory of the motion prior
+
+    Methods
+    -------
+    set: copy a model vector into the buffer
+    """
+
+    def __init__(self, numCam, num_camParam, idx_spline=None, num_traj=0):
+        num_other = numCam * (3 + num_camParam)
+        num_model = idx_spline[1,-1] if idx_spline is not None and idx_spline.size else 3*num_traj
+        self.x = np.zeros(num_other + num_model)
+
+        self.alpha = self.x[:numCam]
+        self.beta = self.x[numCam:2*numCam]
+        self.rs = self.x[2*numCam:3*numCam]
+        self.cam = self.x[3*numCam:num_other].reshape(numCam, num_camParam)
+
+        model = self.x[num_other:]
+        if idx_spline is not None:
+            self.spline = [model[start:end].reshape(3,-1) for start, end in idx_spline.T]
+            self.traj = None
+        else:
+            self.spline = []
+            self.traj = model.reshape(-1,3).T
+
+
+    def set(self, x):
+        np.copyto(self.x, x)
+        return self.x
+
+
+class BAProblem:
+    """
+    Error function of a bundle adjustment problem
+
+    Calling the problem with a model vector assigns the parameters to the scene and returns
+    the errors of all cameras, followed by the errors of the motion prior.
+
+    The problem can be pickled to compute errors in other processes. Only a compact copy of the
+    scene is pickled, the parameter blocks and the camera array are bound again after unpickling.
+
+    Members
+    -------
+    scene : the scene whose parameters are optimized
+    idx_spline : indices of each spline in the model, None if the discrete trajectory is optimized
+    idx_error : start and end of the errors of each camera and of the motion prior
+    blocks : parameter blocks that the splines and the scene read from
+    cam_array : stacked parameters that the cameras read from
+
+    free : mask of the parameters that are optimized, None if all of them are
+
+    Methods
+    -------
+    model: the current parameters as a model vector
+    assign: assign a model vector to the scene
+    set_free: optimize only a subset of the parameters
+    """
+
+    def __init__(self, scene, numCam, num_camParam, idx_spline=None, motion_prior=False, motion_reg=False,
+                 motion_weights=1, num_motion=0, num_threads=0):
+        self.scene = scene
+        self.numCam = numCam
+        self.num_camParam = num_camParam
+        self.idx_spline = idx_spline
+        self.motion_prior = motion_prior
+        self.motion_reg = motion_reg
+        self.motion_weights = motion_weights
+        self.num_threads = num_threads
+        self.free = None
+
+        num_error = [2*scene.detections[i].shape[1] for i in scene.sequence[:numCam]] + [num_motion]
+        self.idx_error = np.concatenate(([0], np.cumsum(num_error)))
+
+        self.bind()
+
+
+    def bind(self):
+        '''
+        Pack the current parameters of the scene into parameter blocks and let the scene read from them
+        '''
+
+        from reconstruction.common import CameraArray
+
+        scene, numCam, cams = self.scene, self.numCam, self.scene.sequence[:self.numCam]
+        calib = scene.settings['opt_calib']
+
+        if self.motion_prior:
+            self.blocks = ParamBlocks(numCam, self.num_camParam, num_traj=scene.global_traj.shape[1])
+            self.blocks.traj[:] = scene.global_traj[4:]
+        else:
+            # Splines read their coefficients directly from the parameter blocks
+            self.blocks = ParamBlocks(numCam, self.num_camParam, self.idx_spline)
+            for i in range(len(self.blocks.spline)):
+                self.blocks.spline[i][:] = scene.spline['tck'][i][1]
+                scene.spline['tck'][i][1] = list(self.blocks.spline[i])
+
+        self.blocks.alpha[:] = scene.alpha[cams]
+        self.blocks.beta[:] = scene.beta[cams]
+        self.blocks.rs[:] = scene.rs[cams]
+        for i in range(numCam):
+            self.blocks.cam[i] = scene.cameras[cams[i]].P2vector(calib=calib)
+
+        # Cameras read their parameters from the stacked camera array
+        self.cam_array = CameraArray([scene.cameras[i] for i in cams])
+        self.cam_array.bind()
+
+        # Errors of cameras are optionally computed in parallel threads
+        self.pool = thread_pool(self.num_threads) if self.num_threads > 1 else None
+        self.x_last, self.error_last = None, None
+
+
+    def model(self):
+        if self.free is None:
+            return self.blocks.x.copy()
+        return self.blocks.x[self.free]
+
+
+    def set_free(self, free):
+        '''
+        Optimize only the parameters in the mask free, the others keep their current values
+
+        Model vectors then only contain the free parameters
+        '''
+
+        self.free = free
+        self.x_full = self.blocks.x.copy()
+
+
+    def expand(self, x):
+        '''
+        Complete a model vector of the free parameters with the fixed parameters
+        '''
+
+        if self.free is None:
+            return x
+        x_full = self.x_full.copy()
+        x_full[self.free] = x
+        return x_full
+
+
+    def assign(self, x):
+        '''
+        Assign a model vector to alpha, beta, rs, cameras and splines (or the discrete trajectory)
+        '''
+
+        scene, cams = self.scene, self.scene.sequence[:self.numCam]
+
+        self.blocks.set(self.expand(x))
+        scene.alpha[cams], scene.beta[cams], scene.rs[cams] = self.blocks.alpha, self.blocks.beta, self.blocks.rs
+        self.cam_array.vector2P(self.blocks.cam, calib=scene.settings['opt_calib'])
+
+        if self.motion_prior:
+            scene.global_traj[4:] = self.blocks.traj
+
+
+    def __call__(self, x):
+        '''
+        Input is the model (parameters that need to be optimized)
+        '''
+
+        scene, numCam, idx_error = self.scene, self.numCam, self.idx_error
+        self.assign(x)
+
+        # Compute errors, each camera writes into its own part of the error vector
+        error = np.empty(idx_error[-1])
+
+        def error_each(i):
+            error[idx_error[i]:idx_error[i+1]] = scene.error_cam(scene.sequence[i], mode='each')
+
+        if self.pool is not None:
+            list(self.pool.map(error_each, range(numCam)))
+        else:
+            for i in range(numCam):
+                error_each(i)
+
+        if self.motion_prior:
+            error[idx_error[numCam]:] = scene.error_motion(scene.sequence[:numCam],motion_weights=self.motion_weights,motion_prior=True)
+        if self.motion_reg:
+            error[idx_error[numCam]:] = scene.error_motion(scene.sequence[:numCam],motion_reg=True,motion_weights=self.motion_weights)
+
+        self.x_last, self.error_last = x.copy(), error.copy()
+        return error
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['blocks', 'cam_array', 'pool', 'x_last', 'error_last']:
+            del state[key]
+        state['scene'] = self.scene.compact()
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bind()
+
+
+# Problem and Jacobian sparsity of the worker processes of a ParallelJacobian
+_worker = {}
+
+
+def _load_problem(path, token):
+    # Each worker reads the problem of a BA call once from the file written by ParallelJacobian
+    if _worker.get('token') != token:
+        with open(path, 'rb') as file:
+            problem, structure = pickle.load(file)
+        problem.pool = None
+        _worker['token'], _worker['problem'], _worker['structure'] = token, problem, structure
+
+
+def _difference_groups(path, token, x0, f0, h, groups, group_ids):
+    '''
+    Forward differences of the columns in the given groups, computed as in scipy.optimize.least_squares
+    '''
+
+    _load_problem(path, token)
+    problem, structure = _worker['problem'], _worker['structure']
+
+    out = []
+    for group in group_ids:
+        e = np.equal(group, groups)
+        x = x0 + h * e
+        dx = x - x0
+        df = problem(x) - f0
+
+        cols, = np.nonzero(e)
+        i, j, _ = find(structure[:, cols])
+        j = cols[j]
+        out.append((i, j, df[i] / dx[j]))
+
+    return out
+
+
+class ParallelJacobian:
+    """
+    Finite difference Jacobian of a BA problem, computed in a pool of processes
+
+    Columns are grouped by the Jacobian sparsity and each group is perturbed at once, exactly as
+    least_squares does with jac_sparsity and '2-point' differences. The groups are distributed over
+    the persistent process pool. The problem is written once to a temporary file, from which each
+    process loads its own copy.
+
+    Use the object as jac for least_squares and close() it after the optimization.
+    """
+
+    def __init__(self, problem, sparsity, bounds=(-np.inf, np.inf), num_processes=2):
+        self.problem = problem
+        self.structure = csc_matrix(sparsity)
+        self.groups = group_columns(self.structure)
+        self.bounds = bounds
+
+        num_groups = np.max(self.groups) + 1
+        self.tasks = [chunk for chunk in np.array_split(np.arange(num_groups), num_processes*4) if len(chunk)]
+        self.pool = process_pool(num_processes)
+
+        fd, self.path = tempfile.mkstemp(prefix='ba_problem_', suffix='.pkl')
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump((problem, self.structure), file)
+        self.token = uuid.uuid4().hex
+
+
+    def __call__(self, x0):
+        # least_squares computes the errors at x0 right before the Jacobian
+        if self.problem.x_last is not None and np.array_equal(x0, self.problem.x_last):
+            f0 = self.problem.error_last
+        else:
+            f0 = self.problem(x0)
+
+        # Step size as in scipy, turned around where it would leave the bounds
+        sign_x0 = (x0 >= 0).astype(float) * 2 - 1
+        h = np.finfo(float).eps**0.5 * sign_x0 * np.maximum(1.0, np.abs(x0))
+        lb, ub = [np.broadcast_to(b, x0.shape) for b in self.bounds]
+        violated = (x0 + h < lb) | (x0 + h > ub)
+        h[violated] *= -1
+
+        futures = [self.pool.submit(_difference_groups, self.path, self.token, x0, f0, h, self.groups, group_ids) for group_ids in self.tasks]
+        parts = [part for future in futures for part in future.result()]
+
+        rows, cols, values = [np.hstack(p) for p in zip(*parts)]
+        return csr_matrix(coo_matrix((values, (rows, cols)), shape=(len(f0), len(x0))))
+
+
+    def close(self):
+        os.remove(self.path)
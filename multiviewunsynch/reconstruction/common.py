@@ -7,9 +7,15 @@ import numpy as np
 from tools import util
 import cv2
 import json
+import copy
+import os
+import pickle
+import warnings
 from reconstruction import epipolar as ep
 from reconstruction import synchronization as sync
+from reconstruction import bundle
 from datetime import datetime
+from itertools import repeat, combinations
 from scipy.optimize import least_squares
 from scipy import interpolate
 from scipy.sparse import lil_matrix, vstack
@@ -17,6 +23,7 @@ from matplotlib import pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from tools import visualization as vis
 from tools import util 
+from tools import result
 
 
 class Scene:
@@ -59,6 +66,7 @@ class Scene:
         self.rs = []
         self.ref_cam = 0
         self.find_order = True
+        self.ba_layout = None
         
 
     def addCamera(self,*camera):
@@ -126,28 +134,12 @@ class Scene:
             detect = self.cameras[i].undist_point(self.detections[i][1:]) if self.settings['undist_points'] else self.detections[i][1:]
             self.detections_global[i] = np.vstack((timestamp, detect))
 
-            if motion_prior:
-                if (self.global_traj[1] == i).any():
-                    # Update glob_traj timestamps for current camera
-                    temp_glob_traj = self.global_traj[:,self.global_traj[1] == i]
-                    # Save traj. point locations in global_traj before update
-                    temp_glob_traj_mask = np.where(self.global_traj[1] == i)
-                    # Select global det. points for current camera
-                    temp_glob_det = self.global_detections[:,self.global_detections[0] == i]
-                    # Save traj. point locations in global_traj
-                    temp_glob_det_mask = np.where(self.global_detections[0] == i)
-                    # Save camera detections that are used within the global traj. 
-                    _,temp_glob_traj_idx,temp_glob_traj_det_idx = np.intersect1d(temp_glob_traj[2],self.detections[i][0],return_indices=True,assume_unique=True)
-                    # Save camera detections that are used within global detections. 
-                    _,temp_glob_det_idx,temp_det_idx = np.intersect1d(temp_glob_det[1],self.detections[i][0],return_indices=True,assume_unique=True)  
-                    
-                    assert np.shape(temp_glob_traj_mask)[1] == np.shape(temp_glob_traj_det_idx)[0],'# of 3D points must equal # of detections'
-                    assert np.shape(temp_glob_det_mask)[1] == np.shape(self.detections_global[i][0])[0],'# of 2D points must equal # of selected global detections'
-                    
-                    # Update global detection timestamps for cam_id
-                    self.global_detections[2,temp_glob_det_mask] = self.detections_global[i][0]
-                    # Update global traj timestamps for detections in global_traj
-                    self.global_traj[3,temp_glob_traj_mask] = self.detections_global[i][0,temp_glob_traj_det_idx]
+            if motion_prior and len(self.global_traj_cols[i]):
+                assert len(self.global_det_cols[i]) == self.detections_global[i].shape[1],'# of 2D points must equal # of selected global detections'
+
+                # Update global detection and global traj. timestamps for cam_id, joined by the detection index
+                self.global_detections[2,self.global_det_cols[i]] = self.detections_global[i][0]
+                self.global_traj[3,self.global_traj_cols[i]] = self.detections_global[i][0,self.global_traj_det[i]]
         if motion_prior:
             # Resort global_traj according to updated global timestamps 
             if not (self.global_traj[3,1:]>=self.global_traj[3,:-1]).all():
@@ -221,51 +213,124 @@ class Scene:
         self.cameras[t2].decompose()
 
 
+    def warm_start(self, path):
+        '''
+        Load camera intrinsics, poses, rolling shutter and alpha from a previous result of the same camera rig, pickled or as a result file
+
+        The camera sequence of the previous result is kept, so that all of its cameras can be reconstructed at once
+        '''
+
+        prev = load_scene(path)
+
+        assert prev.numCam == self.numCam, 'The previous result must contain the same cameras'
+
+        for i in prev.sequence:
+            cam, cam_prev = self.cameras[i], prev.cameras[i]
+            cam.K, cam.d = cam_prev.K.copy(), cam_prev.d.copy()
+            cam.R, cam.t = cam_prev.R.copy(), cam_prev.t.copy()
+            cam.compose()
+
+        self.alpha = np.array(prev.alpha, dtype=float)
+        self.rs = np.array(prev.rs, dtype=float)
+        self.sequence = list(prev.sequence)
+        self.find_order = False
+
+        print('Cameras {} are initialized from {}\n'.format(self.sequence, path))
+
+
+    def triangulate_all(self, thres=0, verbose=0):
+        '''
+        Triangulate the discrete 3D trajectory from all pairs of cameras in the sequence, whose poses must be known
+
+        Points are removed if their reprojection error in either camera is larger than thres
+        '''
+
+        cams = self.sequence
+        self.detection_to_global(cams)
+        cam_array = CameraArray([self.cameras[i] for i in cams])
+
+        X = np.empty([4,0])
+        for a, b in combinations(range(len(cams)), 2):
+            # Detections of the camera with lower fps are interpolated
+            if self.cameras[cams[a]].fps < self.cameras[cams[b]].fps:
+                a, b = b, a
+            try:
+                x1, x2 = util.match_overlap(self.detections_global[cams[a]], self.detections_global[cams[b]])
+            except:
+                continue
+
+            X_i = ep.triangulate_matlab(x1[1:], x2[1:], cam_array.P[a], cam_array.P[b])
+            X_i = np.vstack((x1[0], X_i[:-1]))
+
+            if thres:
+                x_cal = cam_array.projectPoint(X_i[1:], [a, b])
+                err_1 = ep.reprojection_error(x1[1:], x_cal[0])
+                err_2 = ep.reprojection_error(x2[1:], x_cal[1])
+                X_i = X_i[:, np.logical_and(err_1<thres, err_2<thres)]
+
+            if verbose:
+                print('{} points are triangulated from cameras {} and {}'.format(X_i.shape[1], cams[a], cams[b]))
+
+            X = np.hstack((X, X_i))
+
+        # Keep a single point for each timestamp
+        _, idx = np.unique(X[0], return_index=True)
+        self.traj = X[:, idx]
+
+        return self.traj
+
+
     def traj_to_spline(self,smooth_factor):
         '''
         Convert discrete 3D trajectory into spline representation
 
         A single spline is built for each interval
+
+        If "knot_spacing" is set, knots are uniformly spaced instead of searching for a smoothing factor
         '''
 
         assert len(smooth_factor)==2, 'Smoothness should be defined by two parameters (min, max)'
+        knot_spacing = self.settings.get('knot_spacing', 0)
 
         timestamp = self.traj[0]
         interval, idx = util.find_intervals(timestamp,idx=True)
-        tck = [None] * interval.shape[1]
+        parts = [self.traj[:,idx[0,i]:idx[1,i]+1] for i in range(interval.shape[1])]
 
-        for i in range(interval.shape[1]):
-            part = self.traj[:,idx[0,i]:idx[1,i]+1]
+        tck = fit_splines(parts, smooth_factor, knot_spacing, self.settings.get('spline_workers', 0))
 
-            measure = part[0,-1] - part[0,0]
-            s = (1e-3)**2*measure
-            thres_min, thres_max = min(smooth_factor), max(smooth_factor)
-            prev = 0
-            t = 0
-            try:
-                while True:
-                    tck[i], u = interpolate.splprep(part[1:],u=part[0],s=s,k=3)
-
-                    numKnot = len(tck[i][0])-4
-                    if numKnot == prev and numKnot==4 and t==2:
-                        break
-                    else:
-                        prev = numKnot
-                    
-                    if measure/numKnot > thres_max:
-                        s /= 1.5
-                        t = 1
-                    elif measure/numKnot < thres_min:
-                        s *= 2
-                        t = 2
-                    else:
-                        break
+        self.spline['tck'], self.spline['int'] = tck, interval
+        return self.spline
 
-                dist = np.sum(np.sqrt(np.sum((part[1:,1:]-part[1:,:-1])**2,axis=0)))
 
-            except:
-                tck[i], u = interpolate.splprep(part[1:],u=part[0],s=s,k=1)
-            
+    def update_spline(self, t_new, smooth_factor):
+        '''
+        Refit only the intervals of the discrete 3D trajectory that contain new points
+
+        Splines of the other intervals are kept, together with their coefficients refined by BA
+
+        t_new are the timestamps of the new points, which must already be in self.traj
+        '''
+
+        assert len(smooth_factor)==2, 'Smoothness should be defined by two parameters (min, max)'
+        tck_old, interval_old = self.spline['tck'], self.spline['int']
+
+        interval, idx = util.find_intervals(self.traj[0],idx=True)
+        tck = [None] * interval.shape[1]
+        refit = []
+        for i in range(interval.shape[1]):
+            new = np.logical_and(t_new>=interval[0,i], t_new<=interval[1,i]).any()
+            old = np.where(np.logical_and(interval_old[0]<=interval[1,i], interval_old[1]>=interval[0,i]))[0]
+            if not new and len(old)==1:
+                # Keep the spline of this interval and the interval it is defined on
+                tck[i], interval[:,i] = tck_old[old[0]], interval_old[:,old[0]]
+            else:
+                refit.append(i)
+
+        parts = [self.traj[:,idx[0,i]:idx[1,i]+1] for i in refit]
+        tck_new = fit_splines(parts, smooth_factor, self.settings.get('knot_spacing', 0), self.settings.get('spline_workers', 0))
+        for i, tck_i in zip(refit, tck_new):
+            tck[i] = tck_i
+
         self.spline['tck'], self.spline['int'] = tck, interval
         return self.spline
 
@@ -279,8 +344,7 @@ class Scene:
         Outputs are 3D points
         '''
         
-        tck, interval = self.spline['tck'], self.spline['int']
-        self.traj = np.empty([4,0])
+        interval = self.spline['int']
 
         if t is not None:
             assert len(t.shape)==1, 'Input timestamps must be a 1D array'
@@ -288,17 +352,43 @@ class Scene:
         else:
             timestamp = np.arange(interval[0,0], interval[1,-1], sampling_rate)
 
+        self.traj = self.sample_spline(timestamp)
+
+        return self.traj
+
+
+    def sample_spline(self,timestamp):
+        '''
+        Sample the 3D spline at the given timestamps
+
+        Timestamps outside of all intervals are dropped. Outputs are 3D points with the timestamp in the first row
+        '''
+
+        tck, interval = self.spline['tck'], self.spline['int']
+        if not (timestamp[1:] >= timestamp[:-1]).all():
+            timestamp = np.sort(timestamp)
+
+        # Locate the timestamps of each interval and write all points into one buffer
+        start = np.searchsorted(timestamp, interval[0], side='left')
+        end = np.searchsorted(timestamp, interval[1], side='right')
+        traj = np.empty([4, np.sum(np.maximum(end-start,0))])
+
+        num = 0
         for i in range(interval.shape[1]):
-            t_part = timestamp[np.logical_and(timestamp>=interval[0,i], timestamp<=interval[1,i])]
+            t_part = timestamp[start[i]:end[i]]
+            if not len(t_part):
+                continue
             try:
-                traj_part = np.asarray(interpolate.splev(t_part, tck[i]))
+                traj[1:,num:num+len(t_part)] = interpolate.splev(t_part, tck[i])
             except:
                 continue
-            self.traj = np.hstack((self.traj, np.vstack((t_part,traj_part))))
+            traj[0,num:num+len(t_part)] = t_part
+            num += len(t_part)
 
-        assert (self.traj[0,1:] >= self.traj[0,:-1]).all()
+        traj = traj[:,:num]
+        assert (traj[0,1:] >= traj[0,:-1]).all()
 
-        return self.traj
+        return traj
 
 
     def error_cam(self,cam_id,mode='dist',motion_prior=False,norm=False):
@@ -315,24 +405,23 @@ class Scene:
             self.detection_to_global(cam_id)
 
         _, idx = util.sampling(self.detections_global[cam_id], interval, belong=True)
-        detect = np.empty([3,0])
-        point_3D = np.empty([3,0])
-        for i in range(interval.shape[1]):
-            detect_part = self.detections_global[cam_id][:,idx==i+1]
-            if detect_part.size:
-                if motion_prior:
-                    cam_global_traj = self.global_traj[:,self.global_traj[1] == cam_id]
-                    _,traj_idx,detect_idx = np.intersect1d(cam_global_traj[3],detect_part[0],assume_unique=True,return_indices=True)
-                    detect_part = detect_part[:,detect_idx]
-                    detect = np.hstack((detect,detect_part))
-                    point_3D = np.hstack((point_3D,cam_global_traj[4:,traj_idx]))
-                else:
+        if motion_prior:
+            # Trajectory points of this camera that lie inside the spline intervals, joined by the detection index
+            inside = idx[self.global_traj_det[cam_id]] > 0
+            det_idx = self.global_traj_det[cam_id][inside]
+            detect = self.detections_global[cam_id][:,det_idx]
+            point_3D = self.global_traj[4:,self.global_traj_cols[cam_id][inside]]
+        else:
+            detect = np.empty([3,0])
+            point_3D = np.empty([3,0])
+            for i in range(interval.shape[1]):
+                detect_part = self.detections_global[cam_id][:,idx==i+1]
+                if detect_part.size:
                     detect = np.hstack((detect,detect_part)) 
                     point_3D = np.hstack((point_3D, np.asarray(interpolate.splev(detect_part[0], tck[i]))))
                 
-        X = util.homogeneous(point_3D)
         x = detect[1:]
-        x_cal = self.cameras[cam_id].projectPoint(X)
+        x_cal = self.cameras[cam_id].projectPoint(point_3D)
         
         #Normalize Tracks
         if norm:
@@ -349,8 +438,6 @@ class Scene:
             error_x = np.zeros_like(self.detections[cam_id][0])
             error_y = np.zeros_like(self.detections[cam_id][0])
             if motion_prior:
-                _,det_idx,_ = np.intersect1d(self.detections_global[cam_id][0],detect[0],assume_unique=True,return_indices=True)
-                assert det_idx.shape[0] == x_cal.shape[1], '# of detections and traj. points are not equal'
                 error_x[det_idx] = abs(x_cal[0]-x[0])
                 error_y[det_idx] = abs(x_cal[1]-x[1])
             else:
@@ -371,55 +458,33 @@ class Scene:
         '''
 
         interval = self.spline['int']
-        
-        # Update global_detections and global_traj timestamps
-        self.detection_to_global(cams,motion_prior=True)
-        # Update global_traj for motion_reg
-        if motion_reg:
-            self.spline_to_traj()
-            _, idx = util.sampling(self.traj[0], interval, belong=True)
+        motion_type = self.settings['motion_type']
+        assert motion_type == 'F' or motion_type == 'KE','Motion type must be either F or KE' 
+
         if motion_prior:
-            _, idx = util.sampling(self.global_traj[3], interval, belong=True)
+            # Update global_detections and global_traj timestamps
+            self.detection_to_global(cams,motion_prior=True)
+            traj = self.global_traj[3:]
+        elif motion_reg:
+            # Sample the current splines
+            traj = self.spline_to_traj()
+        _, idx = util.sampling(traj[0], interval, belong=True)
 
-        detect = np.empty([3,0])
-        point_3D = np.empty([3,0])
-        temp_glob_ts = np.array([])
-        mot_err_res = np.array([])
-         
+        # Group points by interval, keeping their order within each interval
+        cols = np.argsort(idx, kind='stable')[np.count_nonzero(idx==0):]
+        seg = idx[cols]
 
-        if motion_prior:
-            global_traj_ts = np.array([])
-            for i in range(interval.shape[1]):
-                traj_part = self.global_traj[:,idx==i+1]
-                if traj_part.size:
-                    weights = np.ones(traj_part.shape[1]) * motion_weights
-                    mot_err = self.motion_prior(traj_part[3:],weights,prior=self.settings['motion_type'])
-                    mot_err_res = np.concatenate((mot_err_res, mot_err))
-                    if self.settings['motion_type'] == 'F':
-                        global_traj_ts = np.concatenate((global_traj_ts, traj_part[3,1:-1]))
-                    else:
-                        global_traj_ts = np.concatenate((global_traj_ts, traj_part[3,1:]))
-            motion_error = np.zeros((self.global_traj.shape[1]))
-            _,traj_idx,_ = np.intersect1d(self.global_traj[3],global_traj_ts,assume_unique=True,return_indices=True)
-            assert traj_idx.shape[0] == mot_err_res.shape[0], 'wrong number of global_traj points'
-            motion_error[traj_idx] = mot_err_res
-        
-        elif motion_reg :
-            traj_ts = np.array([]) 
-            motion_error = np.zeros((self.traj.shape[1]))
-            for i in range(interval.shape[1]):
-                traj_part = self.traj[:,idx==i+1]
-                if traj_part.size:
-                    weights = np.ones(traj_part.shape[1]) * motion_weights
-                    mot_err = self.motion_prior(traj_part,weights,prior=self.settings['motion_type'])
-                    mot_err_res = np.concatenate((mot_err_res, mot_err))
-                    assert self.settings['motion_type'] == 'F' or self.settings['motion_type'] == 'KE','Motion type must be either F or KE' 
-                    if self.settings['motion_type'] == 'F':
-                        traj_ts = np.concatenate((traj_ts, traj_part[0,1:-1]))  
-                    elif self.settings['motion_type'] == 'KE':
-                        traj_ts = np.concatenate((traj_ts, traj_part[0,1:])) 
-            _,traj_idx,_ = np.intersect1d(self.traj[0],traj_ts,assume_unique=True,return_indices=True)
-            motion_error[traj_idx] = mot_err_res
+        # Compute the motion prior for all intervals at once and keep only terms whose points lie in a single interval
+        weights = np.full(len(cols), motion_weights, dtype=float)
+        mot_err = self.motion_prior(traj[:,cols],weights,prior=motion_type)
+
+        motion_error = np.zeros(traj.shape[1])
+        if motion_type == 'F':
+            same = (seg[:-2] == seg[1:-1]) & (seg[1:-1] == seg[2:])
+            motion_error[cols[1:-1][same]] = mot_err[same]
+        else:
+            same = seg[:-1] == seg[1:]
+            motion_error[cols[1:][same]] = mot_err[same]
             
         return motion_error
     
@@ -438,56 +503,21 @@ class Scene:
             self.visible.append(visible)
 
 
-    def BA(self, numCam, max_iter=10, rs=False, motion_prior=False,motion_reg=False,motion_weights=1,norm=False,rs_bounds=False):
+    def BA(self, numCam, max_iter=10, rs=False, motion_prior=False,motion_reg=False,motion_weights=1,norm=False,rs_bounds=False,opt_cam=True,opt_traj=True):
         '''
         Bundle Adjustment with multiple splines
 
         The camera order is assumed to be the same as self.sequence
+
+        Cameras (including sync and rs parameters) or the trajectory are kept fixed if opt_cam or opt_traj is False
         '''
 
-        def error_BA(x):
-            '''
-            Input is the model (parameters that need to be optimized)
+        def jac_BA(motion_offset=10):
             '''
+            Jacobian sparsity of the motion prior, where the discrete trajectory is optimized
 
-            # Assign parameters to the class attributes
-            sections = [numCam, numCam*2, numCam*3, numCam*3+numCam*num_camParam]
-            model_parts = np.split(x, sections)
-            self.alpha[self.sequence[:numCam]], self.beta[self.sequence[:numCam]], self.rs[self.sequence[:numCam]] = model_parts[0], model_parts[1], model_parts[2]
-
-            cams = np.split(model_parts[3],numCam)
-            for i in range(numCam):
-                self.cameras[self.sequence[i]].vector2P(cams[i], calib=self.settings['opt_calib']) 
-            
-            if motion_reg:
-                #interpolate 3d points from detections in all cameras
-                self.all_detect_to_traj(self.sequence[:numCam])
-                
-            if motion_prior:
-                self.global_traj[4:] = model_parts[4].reshape(-1,3).T
-            
-            else:
-                spline_parts = np.split(model_parts[4],idx_spline[0,1:])
-                for i in range(len(spline_parts)):
-                    spline_i = spline_parts[i].reshape(3,-1)
-                    self.spline['tck'][i][1] = [spline_i[0],spline_i[1],spline_i[2]]
-            
-            # Compute errors
-            error = np.array([])
-            for i in range(numCam):
-                error_each = self.error_cam(self.sequence[i], mode='each')
-                error = np.concatenate((error, error_each))
-            if motion_prior:
-                error_motion_prior = self.error_motion(self.sequence[:numCam],motion_weights=motion_weights,motion_prior=True)
-                error = np.concatenate((error, error_motion_prior))
-            if motion_reg:
-                error_motion_reg = self.error_motion(self.sequence[:numCam],motion_reg=True,motion_weights=motion_weights)
-                error = np.concatenate((error, error_motion_reg))
-            
-            return error
-
-
-        def jac_BA(near=3,motion_offset=10):
+            The sparsity for splines is cached in self.ba_layout
+            '''
 
             num_param = len(model)
             self.compute_visibility()
@@ -495,11 +525,6 @@ class Scene:
             jac = lil_matrix((1, num_param),dtype=int)
             #jac = np.empty([0,num_param])
 
-            if motion_reg:
-                    m_jac = lil_matrix((self.traj.shape[1], num_param),dtype=int)
-            elif motion_prior:
-                m_jac = lil_matrix((self.global_traj.shape[1], num_param),dtype=int)
-            
             for i in range(numCam):
                 cam_id = self.sequence[i]
                 num_detect = self.detections[cam_id].shape[1]
@@ -527,12 +552,14 @@ class Scene:
                 if motion_prior:
                     traj_start = numCam * (3+num_camParam)
                     traj_len = self.global_traj.shape[1]
+
+                    # Column of the traj. point of each detection in global_traj
+                    traj_col = np.full(num_detect, -1)
+                    traj_col[self.global_traj_det[cam_id]] = self.global_traj_cols[cam_id]
                     for j in range(num_detect):
                         # Verify traj. point lies within current spline interval
                         if self.visible[cam_id][j]:
-                            timestamp = self.detections_global[cam_id][0,j]
-                            traj_pnt = np.where(self.global_traj[3] == timestamp)[0]
-                            traj_pnt += traj_start
+                            traj_pnt = traj_col[j] + traj_start
                             if (traj_pnt-traj_start) < motion_offset:
                                 traj_idx = np.arange(traj_start,traj_pnt+motion_offset)   
                             else:
@@ -548,43 +575,8 @@ class Scene:
                             jac_cam[j] = 0
                         
                     jac = vstack((jac, vstack([jac_cam,jac_cam])))
-                # spline parameters
-                else:
-                    for j in range(num_detect):
-                        spline_id = self.visible[cam_id][j]
-
-                        # Find the corresponding spline for each detecion
-                        if spline_id:
-                            spline_id -= 1
-                            knot = self.spline['tck'][spline_id][0][2:-2]
-                            timestamp = self.detections_global[cam_id][0,j]
-                            knot_idx = np.argsort(abs(knot-timestamp))[:near]
-                            knot_idx = np.concatenate((knot_idx, knot_idx+len(knot), knot_idx+2*len(knot)))
-                            jac_cam[j,idx_spline_sum[0,spline_id]+knot_idx] = 1
 
-                        else:
-                            jac_cam[j,:] = 0
-
-                    jac = vstack((jac, vstack([jac_cam,jac_cam])))
-                    #jac = np.vstack((jac, np.tile(jac_cam,(2,1))))
-
-            if motion_reg:
-                tck, interval = self.spline['tck'], self.spline['int']
-                for j in range(self.traj.shape[1]):
-                    _, spline_id = util.sampling(self.traj[:,j], interval, belong=True)
-                    detect = np.empty([3,0])
-                    point_3D = np.empty([3,0])
-                    
-                    # Find the corresponding spline for each interpolated point
-                    spline_id[0] -= 1
-                    knot = self.spline['tck'][spline_id[0]][0][2:-2]
-                    timestamp = self.traj[0,j]
-                    knot_idx = np.argsort(abs(knot-timestamp))[:near]
-                    knot_idx = np.concatenate((knot_idx, knot_idx+len(knot), knot_idx+2*len(knot)))
-                    m_jac[j,idx_spline_sum[0,spline_id[0]]+knot_idx] = 1
-                jac = vstack((jac, m_jac))
-            
-            elif motion_prior:
+            if motion_prior:
                 m_jac = lil_matrix((self.global_traj.shape[1], num_param),dtype=int)
                 traj_start = numCam * (3+num_camParam)
                 for j in range(self.global_traj.shape[1]):
@@ -613,42 +605,34 @@ class Scene:
         
         '''Before BA'''
         # Define Parameters that will be optimized
-        model_alpha = self.alpha[self.sequence[:numCam]]
-        model_beta = self.beta[self.sequence[:numCam]]
-        model_rs = self.rs[self.sequence[:numCam]]
-
-        model_cam = np.array([])
         num_camParam = 15 if self.settings['opt_calib'] else 6
-        for i in self.sequence[:numCam]:
-            model_cam = np.concatenate((model_cam, self.cameras[i].P2vector(calib=self.settings['opt_calib'])))
-
-        model_other = np.concatenate((model_alpha, model_beta, model_rs, model_cam))
         if motion_prior:
             #interpolate 3d points from detections in all cameras
             self.all_detect_to_traj(self.sequence[:numCam])
         if motion_reg:
             self.spline_to_traj()
         if motion_prior:
-            #interpolate 3d points from detections in all cameras
-            model_traj = np.ravel(self.global_traj[4:].T)
-            model = np.concatenate((model_other, model_traj))
+            num_motion = self.global_traj.shape[1]
+            problem = bundle.BAProblem(self, numCam, num_camParam, motion_prior=True, motion_weights=motion_weights,
+                                       num_motion=num_motion, num_threads=self.settings.get('ba_threads', 0))
         else:
-            # Reorganized splines into 1D and record indices of each spline
-            num_spline = len(self.spline['tck'])
-            idx_spline = np.zeros((2,num_spline),dtype=int)
-            start = 0
-            model_spline = np.array([])
-            for i in range(num_spline):
-                model_spline_i = np.ravel(self.spline['tck'][i][1])
-                model_spline = np.concatenate((model_spline, model_spline_i))
-
-                end = start + len(model_spline_i)
-                idx_spline[:,i] = [start,end]
-                start = end
-
-            idx_spline_sum = idx_spline + len(model_other)
-            model = np.concatenate((model_other, model_spline))
-            assert idx_spline_sum[-1,-1] == len(model), 'Error in spline indices'
+            # Reuse the packing of splines and the Jacobian sparsity of the previous BA if possible
+            opt_sync = self.settings.get('opt_sync', True)
+            layout = self.ba_layout
+            if layout is None or not layout.matches(self.sequence[:numCam], num_camParam, self.spline,
+                                                    rs=rs, opt_sync=opt_sync, motion_reg=motion_reg):
+                layout = bundle.BALayout(self.sequence[:numCam], num_camParam, self.spline,
+                                         rs=rs, opt_sync=opt_sync, motion_reg=motion_reg)
+                self.ba_layout = layout
+            layout.update(self)
+
+            num_motion = layout.motion.shape[0] if motion_reg else 0
+            problem = bundle.BAProblem(self, numCam, num_camParam, layout.idx_spline, motion_reg=motion_reg,
+                                       motion_weights=motion_weights, num_motion=num_motion,
+                                       num_threads=self.settings.get('ba_threads', 0))
+            assert layout.num_param == len(problem.blocks.x), 'Error in spline indices'
+
+        model = problem.model()
         print('Number of BA parameters is {}'.format(len(model)))
 
         # constrain rs params to between 0 and 1
@@ -662,34 +646,45 @@ class Scene:
             bounds_rs = (-np.inf,np.inf)
 
         # Set the Jacobian matrix
-        A = jac_BA()
+        A = jac_BA() if motion_prior else layout.sparsity()
+
+        # Optimize only a subset of the parameters, those without any residual are fixed as well
+        if not (opt_cam and opt_traj):
+            free = np.ones(len(model), dtype=bool)
+            free[:numCam*(3+num_camParam)] = opt_cam
+            free[numCam*(3+num_camParam):] = opt_traj
+            free &= np.asarray((A != 0).sum(axis=0)).ravel() > 0
+            problem.set_free(free)
+            model = problem.model()
+            A = A[:,free]
+            if rs_bounds:
+                bounds_rs = (l_bounds[free], u_bounds[free])
+            print('Number of free BA parameters is {}'.format(len(model)))
+            if not len(model):
+                return None
 
         '''Compute BA'''
         print('Doing BA with {} cameras...\n'.format(numCam))
-        fn = lambda x: error_BA(x)
-        res = least_squares(fn,model,jac_sparsity=A,tr_solver='lsmr',xtol=1e-12,max_nfev=max_iter,verbose=0,bounds=bounds_rs)
+        num_processes = self.settings.get('ba_processes', 0)
+        if num_processes > 1:
+            # Finite differences of the Jacobian are computed in parallel processes
+            jac = bundle.ParallelJacobian(problem, A, bounds=bounds_rs, num_processes=num_processes)
+            try:
+                res = least_squares(problem,model,jac=jac,tr_solver='lsmr',xtol=1e-12,max_nfev=max_iter,verbose=0,bounds=bounds_rs)
+            finally:
+                jac.close()
+        else:
+            res = least_squares(problem,model,jac_sparsity=A,tr_solver='lsmr',xtol=1e-12,max_nfev=max_iter,verbose=0,bounds=bounds_rs)
 
         '''After BA'''
         # Assign the optimized model to alpha, beta, cam, and spline
-        sections = [numCam, numCam*2, numCam*3, numCam*3+numCam*num_camParam]
-        model_parts = np.split(res.x, sections)
-        self.alpha[self.sequence[:numCam]], self.beta[self.sequence[:numCam]], self.rs[self.sequence[:numCam]] = model_parts[0], model_parts[1], model_parts[2]
-        
-        cams = np.split(model_parts[3],numCam)
-        for i in range(numCam):
-            self.cameras[self.sequence[i]].vector2P(cams[i], calib=self.settings['opt_calib']) 
+        problem.assign(res.x)
         if motion_prior:
-            self.global_traj[4:] = model_parts[4].reshape(-1,3).T
             if (self.global_traj[3][1:]>self.global_traj[3][:-1]).all():
                 self.traj_to_spline(smooth_factor=self.settings['smooth_factor'])
             else:
                 self.traj = self.global_traj[3:,np.argsort(self.global_traj[3,:])] 
                 self.traj_to_spline(smooth_factor=self.settings['smooth_factor'])
-        else:
-            spline_parts = np.split(model_parts[4],idx_spline[0,1:])
-            for i in range(len(spline_parts)):
-                spline_i = spline_parts[i].reshape(3,-1)
-                self.spline['tck'][i][1] = [spline_i[0],spline_i[1],spline_i[2]]
 
         # Update global timestamps for each serie of detections
         self.detection_to_global()
@@ -697,6 +692,162 @@ class Scene:
         return res
 
 
+    def BA_pyramid(self, numCam, factors=None, max_iter_full=None, **kwargs):
+        '''
+        Coarse-to-fine Bundle Adjustment
+
+        BA is first computed on temporally decimated detections, keeping every k-th detection of each camera for each factor k,
+        and finally on all detections starting from the converged state, with at most max_iter_full iterations, by default 3.
+        Other arguments are passed to BA
+        '''
+
+        factors = self.settings.get('ba_pyramid', []) if factors is None else factors
+        max_iter_full = self.settings.get('ba_pyramid_iter', 3) if max_iter_full is None else max_iter_full
+        cams = self.sequence[:numCam]
+
+        detections = list(self.detections)
+        try:
+            for k in sorted(factors, reverse=True):
+                if k > 1:
+                    for i in cams:
+                        self.detections[i] = detections[i][:,::k]
+                    print('Coarse BA with every {}th detection'.format(k))
+                    self.BA(numCam, **kwargs)
+        finally:
+            self.detections[:] = detections
+
+        return self.BA(numCam, **dict(kwargs, max_iter=max_iter_full))
+
+
+    def BA_sharded(self, numCam, window=None, overlap=None, num_rounds=None, num_processes=None, max_detections=None, **kwargs):
+        '''
+        Bundle Adjustment in temporal shards for long flights
+
+        Each round first optimizes cameras, sync and rs parameters together with the splines on decimated detections, keeping every k-th
+        detection of each camera such that at most max_detections remain. Then the splines of each window, extended by the overlap on
+        both sides, are optimized with fixed cameras and only the detections of that window. In the overlap of two windows, spline
+        coefficients are blended with weights that fall linearly towards the end of each window, so there are no seams between windows.
+
+        Windows are optimized in parallel processes if num_processes > 1. Other arguments are passed to BA
+        '''
+
+        assert not kwargs.get('motion_prior', False), 'Sharded BA only supports splines'
+        window = self.settings['ba_window'] if window is None else window
+        overlap = self.settings.get('ba_overlap', window/4) if overlap is None else overlap
+        num_rounds = self.settings.get('ba_rounds', 2) if num_rounds is None else num_rounds
+        num_processes = self.settings.get('ba_processes', 0) if num_processes is None else num_processes
+        max_detections = self.settings.get('ba_shard_detections', 1000) if max_detections is None else max_detections
+        assert 0 < overlap <= window/2, 'Overlap of sharded BA must be positive and at most half of the window'
+        cams = self.sequence[:numCam]
+
+        interval = self.spline['int']
+        start = np.arange(interval[0,0], interval[1,-1], window)
+        cores = np.vstack((start, start+window))
+        cores[0,0], cores[1,-1] = -np.inf, np.inf
+
+        for r in range(num_rounds):
+            # Cameras and splines on decimated detections
+            detections = list(self.detections)
+            try:
+                for i in cams:
+                    self.detections[i] = detections[i][:,::int(np.ceil(detections[i].shape[1] / max_detections)) or 1]
+                res = self.BA(numCam, **kwargs)
+            finally:
+                self.detections[:] = detections
+                self.detection_to_global()
+
+            # Splines of each window with fixed cameras
+            shards = [self.shard(numCam, w0-overlap, w1+overlap) for w0, w1 in cores.T]
+            scenes = [scene for scene, _ in shards]
+            if num_processes > 1:
+                for scene in scenes:
+                    scene.settings = dict(scene.settings, ba_processes=0, ba_threads=0)
+                coeffs = list(bundle.process_pool(num_processes).map(ba_shard, scenes, repeat(numCam), repeat(kwargs)))
+            else:
+                coeffs = [ba_shard(scene, numCam, kwargs) for scene in scenes]
+
+            # Blend the shards by the center of the support of each coefficient, weights of overlapping windows sum to one
+            # Coefficients outside of all windows keep their value
+            tck = self.spline['tck']
+            update = [np.zeros((len(tck_i[1]), len(tck_i[1][0]))) for tck_i in tck]
+            for (_, idx_int), (w0, w1), coeff in zip(shards, cores.T, coeffs):
+                for j, i in enumerate(idx_int):
+                    t, k = tck[i][0], tck[i][2]
+                    center = (t[:len(t)-k-1] + t[k+1:]) / 2
+                    weight = np.clip((center-w0+overlap) / (2*overlap), 0, 1) * np.clip((w1+overlap-center) / (2*overlap), 0, 1)
+                    update[i] += weight * (coeff[j] - np.asarray(tck[i][1]))
+            for i in range(len(tck)):
+                for d in range(len(tck[i][1])):
+                    tck[i][1][d] += update[i][d]
+
+        self.detection_to_global()
+
+        return res
+
+
+    def shard(self, numCam, t_start, t_end):
+        '''
+        Create an independent copy of the scene with only the detections and spline intervals within [t_start, t_end)
+
+        Intervals are clipped to the window. Also returns the indices of the intervals in the shard
+        '''
+
+        self.detection_to_global()
+
+        scene = Scene()
+        for key in ['numCam', 'cf', 'settings', 'sequence', 'ref_cam', 'find_order']:
+            setattr(scene, key, getattr(self, key))
+        scene.cameras = copy.deepcopy(self.cameras)
+        scene.alpha, scene.beta, scene.rs = self.alpha.copy(), self.beta.copy(), self.rs.copy()
+        scene.detections_global = [[] for i in range(self.numCam)]
+        for i in range(self.numCam):
+            timestamp = self.detections_global[i][0]
+            scene.detections.append(self.detections[i][:,np.logical_and(timestamp>=t_start, timestamp<t_end)])
+
+        interval = self.spline['int']
+        idx_int = np.where(np.logical_and(interval[1]>t_start, interval[0]<t_end))[0]
+        scene.spline = {'tck': [[self.spline['tck'][i][0].copy(), [c.copy() for c in self.spline['tck'][i][1]], self.spline['tck'][i][2]] for i in idx_int],
+                        'int': np.clip(interval[:,idx_int], t_start, t_end)}
+
+        return scene, idx_int
+
+
+    def compact(self):
+        '''
+        Create a scene that shares only the data needed to compute reprojection errors
+
+        Intermediate results like raw detections and sampled trajectories are left out, e.g. to send the scene to other processes
+        '''
+
+        scene = Scene()
+        for key in ['numCam', 'cameras', 'detections', 'alpha', 'beta', 'rs', 'cf', 'settings', 'sequence', 'spline', 'ref_cam', 'find_order']:
+            setattr(scene, key, getattr(self, key))
+        scene.detections_global = [[] for i in range(self.numCam)]
+
+        # Discrete trajectory of the motion prior
+        for key in ['global_traj', 'global_detections', 'global_keys', 'global_traj_keys', 'global_det_cols', 'global_traj_cols', 'global_traj_det']:
+            if hasattr(self, key):
+                setattr(scene, key, getattr(self, key))
+
+        return scene
+
+
+    def save_checkpoint(self, path, num_cam):
+        '''
+        Save the state of the incremental reconstruction after num_cam cameras have been registered and bundle adjusted
+
+        Only the compact scene is saved, see compact, together with the ground truth that the output is aligned with. Everything else
+        is recomputed by the next stages. The state of the random number generator is saved as well, so that the reconstruction
+        continues exactly as without interruption. The previous checkpoint is replaced only once the new one is written
+        '''
+
+        scene = self.compact()
+        scene.gt = self.gt
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump({'num_cam': num_cam, 'scene': scene, 'random_state': np.random.get_state()}, file)
+        os.replace(path + '.tmp', path)
+
+
     def remove_outliers(self, cams, thres=30, verbose=False):
         '''
         Remove raw detections that have large reprojection errors.
@@ -713,10 +864,91 @@ class Scene:
                 self.detections[i] = self.detections[i][:,error<thres]
                 self.detection_to_global(i)
 
+                # Drop the same detections from the cached BA layout
+                if self.ba_layout is not None:
+                    self.ba_layout.remove_detections(i, error<thres)
+
                 if verbose:
                     print('{} out of {} detections are removed for camera {}'.format(sum(error>=thres),sum(error!=0),i))
 
 
+    def decimate_detections(self, cams, max_per_knot, verbose=True):
+        '''
+        Select at most max_per_knot raw detections of each camera within each knot span of the 3D spline
+
+        Each knot span is divided into max_per_knot equal parts and the detection with the smallest reprojection error
+        is kept in each part. Detections outside of the spline are all kept. Detections are not changed, see BA_decimated
+
+        Returns a dictionary with the mask of the kept detections of each camera
+        '''
+
+        tck, interval = self.spline['tck'], self.spline['int']
+        num_before, num_after = 0, 0
+        masks = {}
+
+        for i in cams:
+            error_all = self.error_cam(i,mode='each')
+            error_xy = np.split(error_all,2)
+            error = np.sqrt(error_xy[0]**2 + error_xy[1]**2)
+
+            timestamp = self.detections_global[i][0]
+            _, idx = util.sampling(timestamp, interval, belong=True)
+
+            keep = idx == 0
+            for j in range(interval.shape[1]):
+                det = np.where(idx==j+1)[0]
+                if not len(det):
+                    continue
+
+                # Part of the knot span that each detection falls into
+                knots = np.unique(tck[j][0])
+                span = np.clip(np.searchsorted(knots, timestamp[det], side='right')-1, 0, len(knots)-2)
+                frac = (timestamp[det] - knots[span]) / (knots[span+1] - knots[span])
+                part = span*max_per_knot + np.clip((frac*max_per_knot).astype(int), 0, max_per_knot-1)
+
+                # Smallest error in each part
+                order = np.lexsort((error[det], part))
+                first = np.append(True, part[order][1:] != part[order][:-1])
+                keep[det[order[first]]] = True
+
+            num_before += len(keep)
+            num_after += sum(keep)
+            masks[i] = keep
+
+            if verbose:
+                print('{} out of {} detections are kept for camera {}'.format(sum(keep),len(keep),i))
+
+        if verbose:
+            print('Ratio of kept detections after decimation: {:.3f}'.format(num_after / num_before if num_before else 1))
+
+        return masks
+
+
+    def BA_decimated(self, numCam, max_per_knot=None, bundle_adjust=None, **kwargs):
+        '''
+        Bundle Adjustment on decimated detections, see decimate_detections
+
+        Only the BA sees the decimated detections, all raw detections are restored afterwards. bundle_adjust is the BA method,
+        e.g. BA_sharded or BA_pyramid, by default BA. Other arguments are passed to it
+        '''
+
+        max_per_knot = self.settings['max_detections_per_knot'] if max_per_knot is None else max_per_knot
+        bundle_adjust = self.BA if bundle_adjust is None else bundle_adjust
+        cams = self.sequence[:numCam]
+
+        masks = self.decimate_detections(cams, max_per_knot)
+        detections = list(self.detections)
+        try:
+            for i in cams:
+                self.detections[i] = detections[i][:,masks[i]]
+            res = bundle_adjust(numCam, **kwargs)
+        finally:
+            self.detections[:] = detections
+            self.detection_to_global()
+
+        return res
+
+
     def get_camera_pose(self, cam_id, error=8, verbose=0):
         '''
         Get the absolute pose of a camera by solving the PnP problem.
@@ -743,9 +975,9 @@ class Scene:
         distCoeffs = self.cameras[cam_id].d
         retval, rvec, tvec, inliers = cv2.solvePnPRansac(objectPoints, imagePoints, self.cameras[cam_id].K, distCoeffs, reprojectionError=error)
 
-        self.cameras[cam_id].R = cv2.Rodrigues(rvec)[0]
-        self.cameras[cam_id].t = tvec.reshape(-1,)
-        self.cameras[cam_id].compose()
+        cam_array = CameraArray([self.cameras[cam_id]])
+        cam_array.vector2P(np.hstack((rvec.T, tvec.T)))
+        cam_array.bind()
 
         if verbose:
             print('{} out of {} points are inliers for PnP'.format(inliers.shape[0], N))
@@ -769,8 +1001,9 @@ class Scene:
         detect_new = self.detections_global[cam_id][:, np.logical_not(idx_ex)]
 
         # Matching these detections with detections from previous cameras and triangulate them
+        cam_array = CameraArray([self.cameras[i] for i in [cam_id, *cams]])
         X_new = np.empty([4,0])
-        for i in cams:
+        for k, i in enumerate(cams, start=1):
             self.detection_to_global(i)
             detect_ex = self.detections_global[i]
 
@@ -780,14 +1013,15 @@ class Scene:
             except:
                 continue
             else:
-                P1, P2 = self.cameras[cam_id].P, self.cameras[i].P
+                P1, P2 = cam_array.P[0], cam_array.P[k]
                 X_i = ep.triangulate_matlab(x1[1:], x2[1:], P1, P2)
                 X_i = np.vstack((x1[0], X_i[:-1]))
 
                 # Check reprojection error directly after triangulation, preserve those with small error
                 if thres:
-                    err_1 = ep.reprojection_error(x1[1:], self.cameras[cam_id].projectPoint(X_i[1:]))
-                    err_2 = ep.reprojection_error(x2[1:], self.cameras[i].projectPoint(X_i[1:]))
+                    x_cal = cam_array.projectPoint(X_i[1:], [0, k])
+                    err_1 = ep.reprojection_error(x1[1:], x_cal[0])
+                    err_2 = ep.reprojection_error(x2[1:], x_cal[1])
                     mask = np.logical_and(err_1<thres, err_2<thres)
                     X_i = X_i[:, mask]
                     
@@ -809,7 +1043,9 @@ class Scene:
         self.traj = self.traj[:, idx]
 
         # refit the 3D spline if wanted
-        if refit:
+        if refit and self.settings.get('incremental_refit', False):
+            self.update_spline(X_new[0], smooth_factor=factor_t2s)
+        elif refit:
             self.traj_to_spline(smooth_factor=factor_t2s)
 
         return X_new
@@ -889,59 +1125,52 @@ class Scene:
         global_time_stamps_all = np.array([])
         frame_id_all = np.array([])
         cam_id = np.array([])
+        det_id = np.array([],dtype=int)
 
-        if len(cam):
-            for i in cam[0]:
-                self.detection_to_global(i)
-                global_time_stamps_all = np.concatenate((global_time_stamps_all,self.detections_global[i][0]))
-                frame_id_all  = np.concatenate((frame_id_all,self.detections[i][0]))
-                cam_id = np.concatenate((cam_id,np.ones(len(self.detections[i][0])) * i ))
-
-        else:
-            for i in range(self.numCam):
-                self.detection_to_global(i)
-                global_time_stamps_all = np.concatenate((global_time_stamps_all,self.detections_global[i][0]))
-                frame_id_all = np.concatenate((frame_id_all,self.detections[i][0]))
-                cam_id = np.concatenate((cam_id,np.ones(len(self.detections[i][0])) * i ))
+        cams = cam[0] if len(cam) else range(self.numCam)
+        for i in cams:
+            self.detection_to_global(i)
+            global_time_stamps_all = np.concatenate((global_time_stamps_all,self.detections_global[i][0]))
+            frame_id_all = np.concatenate((frame_id_all,self.detections[i][0]))
+            cam_id = np.concatenate((cam_id,np.ones(len(self.detections[i][0])) * i ))
+            det_id = np.concatenate((det_id,np.arange(len(self.detections[i][0]))))
 
         self.frame_id_all = frame_id_all 
-        #global_time_stamps_all = np.sort(global_time_stamps_all)
-        #Remove duplicate timestamps
-        #if (global_time_stamps_all[1:]==global_time_stamps_all[:-1]).any():
-        #    gt_uniq = remove_dupes(global_time_stamps_all)
-        #    fram_id_uniq = remove_dupes(frame_id_all)
-        #    gt_uniq = global_time_stamps_all[1:][(global_time_stamps_all[1:]>global_time_stamps_all[:-1])]
-        #    gt_dupes = global_time_stamps_all[1:][(global_time_stamps_all[1:] == global_time_stamps_all[:-1])]
-        #    gt_uniq = np.hstack((global_time_stamps_all[0],gt_uniq))
-        #    assert (gt_uniq[1:]>gt_uniq[:-1]).all()
-        #    self.global_time_stamps_all = gt_uniq #global_time_stamps_all
-        #else:
         self.global_time_stamps_all = global_time_stamps_all
-
-        #assert (global_time_stamps_all[1:]>=global_time_stamps_all[:-1]).all()
-        
         
         # Interpolate 3D points for global timestamps in all cameras
         self.spline_to_traj(t=np.sort(global_time_stamps_all))
 
         self.global_detections = np.vstack((cam_id,frame_id_all,global_time_stamps_all))
+        # Stable keys (camera id, detection index) of each global detection
+        self.global_keys = np.vstack((cam_id.astype(int),det_id))
+
         #Sort global_traj by global time stamp
-        temp_global_traj = self.global_detections[:,np.argsort(self.global_detections[2,:])]
-        
-        # Remove duplicate timestamps from temp traj.
-        #temp_global_traj = np.hstack((temp_global_traj[:,0].reshape(3,1),temp_global_traj[:,1:][:,(temp_global_traj[2][1:]>temp_global_traj[2][:-1])]))
-        
-        # Remove duplicate timestamps from self.traj.
-        #if (self.traj[0][1:]==self.traj[0][:-1]).any():
-        #    self.traj = np.hstack((self.traj[:,0].reshape(4,1),self.traj[:,1:][:,(self.traj[0][1:]>self.traj[0][:-1])]))
-        
+        order = np.argsort(self.global_detections[2,:])
+        temp_global_traj = self.global_detections[:,order]
+
+        # Keep detections inside the spline intervals, the same as the interpolated points of spline_to_traj
+        interval = self.spline['int']
+        inside = np.zeros(temp_global_traj.shape[1],dtype=bool)
+        for i in range(interval.shape[1]):
+            inside |= (temp_global_traj[2]>=interval[0,i]) & (temp_global_traj[2]<=interval[1,i])
+        assert np.array_equal(temp_global_traj[2,inside],self.traj[0]), 'Interpolated 3D points do not match the detections'
+
         # Create ascending global timestamp trajectory
-        #_,traj_idx,_= np.intersect1d(temp_global_traj[2],self.traj[0],assume_unique=False,return_indices=True)
-        traj_idx = np.isin(temp_global_traj[2],self.traj[0])
-        temp_global_traj = np.vstack((temp_global_traj[:,traj_idx],self.traj[1:]))
+        temp_global_traj = np.vstack((temp_global_traj[:,inside],self.traj[1:]))
         # Apply index to track original order of the global traj.
         temp_global_traj = np.vstack((np.arange(temp_global_traj.shape[1]),temp_global_traj))
         self.global_traj = temp_global_traj
+        self.global_traj_keys = self.global_keys[:,order[inside]]
+
+        # For each camera, columns in global_detections and global_traj, and the detection index of each traj. point
+        self.global_det_cols, self.global_traj_cols, self.global_traj_det = [], [], []
+        for i in range(self.numCam):
+            self.global_det_cols.append(np.nonzero(self.global_keys[0]==i)[0])
+            cols = np.nonzero(self.global_traj_keys[0]==i)[0]
+            cols = cols[np.argsort(self.global_traj_keys[1,cols])]
+            self.global_traj_cols.append(cols)
+            self.global_traj_det.append(self.global_traj_keys[1,cols])
         
         #verify global timestamps are sorted in ascending order
         assert (self.global_traj[3][1:]>=self.global_traj[3][:-1]).all(), 'timestamps are not in ascending order'
@@ -1072,11 +1301,7 @@ class Camera:
     def projectPoint(self,X):
 
         assert self.P is not None, 'The projection matrix P has not been calculated yet'
-        if X.shape[0] == 3:
-            X = util.homogeneous(X)
-        x = np.dot(self.P,X)
-        x /= x[2]
-        return x
+        return util.project(self.P,X)
 
 
     def compose(self):
@@ -1149,6 +1374,8 @@ class Camera:
         assert points.shape[0]==2, 'Input must be a 2D array'
 
         num = points.shape[1]
+        if not num:
+            return points.copy()
 
         src = np.ascontiguousarray(points.T).reshape((num,1,2))
         dst = cv2.undistortPoints(src, self.K, self.d)
@@ -1168,14 +1395,185 @@ class Camera:
         print(self.t)
 
 
-def create_scene(path_input):
+class CameraArray:
+    """ 
+    Class that stacks the parameters of several cameras for vectorized computations
+
+    The cameras keep their own parameters, use bind() to point them at the stacked parameters.
+    
+    Members
+    -------
+    cameras : list of elements of class Camera
+    K : calibration matrices (N,3,3)
+    R : camera orientations (N,3,3)
+    t : camera translations (N,3)
+    d : distortion coefficients (N,5)
+    P : camera matrices (N,3,4)
+
+    Methods
+    -----
+    projectPoint: get 2D coords from x=PX in one or more cameras
+    compose: compose all P from K,R,t
+    vector2P: convert a vector for each camera into camera parameters
+    bind: let each camera use the stacked parameters
+
+    """
+
+    def __init__(self,cameras):
+        self.cameras = list(cameras)
+        num = len(self.cameras)
+
+        self.K = np.array([cam.K for cam in self.cameras], dtype=float).reshape(num,3,3)
+        self.d = np.array([cam.d for cam in self.cameras], dtype=float).reshape(num,-1)
+        self.R = np.array([cam.R if cam.R is not None else np.eye(3) for cam in self.cameras], dtype=float).reshape(num,3,3)
+        self.t = np.array([cam.t if cam.t is not None else np.zeros(3) for cam in self.cameras], dtype=float).reshape(num,3)
+        self.P = np.zeros((num,3,4))
+        self.compose()
+
+
+    def projectPoint(self,X,idx=None):
+        '''
+        Project 3D points X (3,M) into the cameras
+
+        idx selects the cameras: None for all cameras (output N,3,M), a single camera (output 3,M),
+        or an iterable of cameras (output len(idx),3,M)
+        '''
+
+        P = self.P if idx is None else self.P[idx]
+        return util.project(P,X)
+
+
+    def compose(self):
+        np.matmul(self.K, self.R, out=self.P[:,:,:3])
+        np.matmul(self.K, self.t[:,:,None], out=self.P[:,:,3:])
+
+
+    def vector2P(self, vectors, calib=False):
+        '''
+        Convert a vector for each camera (N,6) or (N,15) into camera parameters, see Camera.vector2P
+        '''
+
+        if calib:
+            self.K[:] = np.eye(3)
+            self.K[:,0,0], self.K[:,1,1] = vectors[:,0], vectors[:,1]
+            self.K[:,:2,-1] = vectors[:,2:4]
+            self.R[:] = util.rodrigues(vectors[:,4:7])
+            self.t[:] = vectors[:,7:10]
+            self.d[:] = vectors[:,10:]
+        else:
+            self.R[:] = util.rodrigues(vectors[:,:3])
+            self.t[:] = vectors[:,3:6]
+
+        self.compose()
+        return self.P
+
+
+    def bind(self):
+        '''
+        Replace the parameters of each camera by views into the stacked parameters
+        '''
+
+        for i, cam in enumerate(self.cameras):
+            cam.K, cam.R, cam.t, cam.d, cam.P = self.K[i], self.R[i], self.t[i], self.d[i], self.P[i]
+
+
+def fit_spline(part, smooth_factor, knot_spacing=0):
+    '''
+    Fit a spline to one continuous part of the trajectory (rows are timestamp, x, y, z)
+
+    See Scene.traj_to_spline
+    '''
+
+    measure = part[0,-1] - part[0,0]
+    s = (1e-3)**2*measure
+    thres_min, thres_max = min(smooth_factor), max(smooth_factor)
+    prev = 0
+    t = 0
+
+    if knot_spacing:
+        # Least-squares fit with knots on a fixed grid, gaps in the data are handled by lsq_spline
+        return util.lsq_spline(part[0],part[1:],knot_spacing)
+
+    try:
+        while True:
+            tck, u = interpolate.splprep(part[1:],u=part[0],s=s,k=3)
+
+            numKnot = len(tck[0])-4
+            if numKnot == prev and numKnot==4 and t==2:
+                break
+            else:
+                prev = numKnot
+            
+            if measure/numKnot > thres_max:
+                s /= 1.5
+                t = 1
+            elif measure/numKnot < thres_min:
+                s *= 2
+                t = 2
+            else:
+                break
+
+    except:
+        tck, u = interpolate.splprep(part[1:],u=part[0],s=s,k=1)
+
+    return tck
+
+
+def fit_splines(parts, smooth_factor, knot_spacing=0, num_workers=0):
+    '''
+    Fit a spline to each of the independent parts of the trajectory, optionally in parallel processes
+
+    Processes are kept alive between calls and shared with the parallel BA, see bundle.process_pool
+    '''
+
+    if num_workers > 1 and len(parts) > 1:
+        return list(bundle.process_pool(num_workers).map(fit_spline, parts, repeat(smooth_factor), repeat(knot_spacing)))
+    else:
+        return [fit_spline(part, smooth_factor, knot_spacing) for part in parts]
+
+
+def ba_shard(scene, numCam, kwargs):
+    '''
+    Optimize the splines of a shard with fixed cameras and return their coefficients, see Scene.BA_sharded
+    '''
+
+    if sum(scene.detections[i].shape[1] for i in scene.sequence[:numCam]):
+        scene.BA(numCam, opt_cam=False, **kwargs)
+
+    return [np.asarray(tck[1]) for tck in scene.spline['tck']]
+
+
+# Parsed calibration files of this process by path and modification time, shared by all scenes
+calibrations = {}
+
+
+def load_calibration(path):
+    '''
+    Read a camera calibration file, each file is only parsed once per process unless it changes
+    '''
+
+    try:
+        key = (os.path.abspath(path), os.path.getmtime(path))
+        if key not in calibrations:
+            with open(path, 'r') as file:
+                calibrations[key] = json.load(file)
+    except:
+        raise Exception('Wrong input of camera')
+
+    return copy.deepcopy(calibrations[key])
+
+
+def create_scene(path_input, config=None):
     '''
     Create a scene from the imput template in json format
+
+    An already parsed config can be given instead, e.g. with settings that are tracked by tools.cache
     '''
 
     # Read the config file
-    with open(path_input, 'r') as file:
-        config = json.load(file)
+    if config is None:
+        with open(path_input, 'r') as file:
+            config = json.load(file)
 
     # Create the scene
     flight = Scene()
@@ -1193,11 +1591,7 @@ def create_scene(path_input):
     # Load cameras
     path_cam = config['necessary inputs']['path_cameras']
     for path in path_cam:
-        try:
-            with open(path, 'r') as file:
-                cam = json.load(file)
-        except:
-            raise Exception('Wrong input of camera')
+        cam = load_calibration(path)
 
         if len(cam['distCoeff']) == 4:
             cam['distCoeff'].append(0)
@@ -1228,3 +1622,66 @@ def create_scene(path_input):
 
     print('Input data are loaded successfully, a scene is created.\n')
     return flight
+
+
+def load_checkpoint(path, settings=None):
+    '''
+    Load the scene and the number of processed cameras from a checkpoint of Scene.save_checkpoint
+
+    The scene keeps the settings it was saved with, so that it continues as without interruption. If the settings of the config
+    are given, a warning lists the keys whose values differ from the checkpoint
+    '''
+
+    assert os.path.isfile(path), 'No checkpoint to resume from at {}'.format(path)
+    with open(path, 'rb') as file:
+        state = pickle.load(file)
+    np.random.set_state(state['random_state'])
+
+    if settings is not None:
+        saved = state['scene'].settings
+        changed = sorted(key for key in set(settings) | set(saved)
+                         if json.dumps(settings.get(key), default=str) != json.dumps(saved.get(key), default=str))
+        if changed:
+            warnings.warn('Settings {} of the config differ from the checkpoint {}, the values of the checkpoint are used'.format(changed, path))
+
+    print('Resuming with {} cameras from {}\n'.format(state['num_cam'], path))
+    return state['scene'], state['num_cam']
+
+
+def load_scene(path):
+    '''
+    Load a reconstructed scene, either pickled or from a result file of tools.result (.npz)
+
+    A scene loaded from a result file has no detections, but everything needed to sample the trajectory or to reuse the cameras
+    '''
+
+    if not str(path).endswith('.npz'):
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    with result.load_result(path) as res:
+        flight = Scene()
+        flight.settings = res.settings()
+        flight.numCam = len(res['fps'])
+        flight.sequence = [int(i) for i in res['sequence']]
+        flight.ref_cam = int(res['ref_cam'])
+        flight.find_order = False
+        flight.alpha, flight.beta, flight.rs, flight.cf = res['alpha'], res['beta'], res['rs'], res['cf']
+
+        K, d, R, t = res['K'], res['d'], res['R'], res['t']
+        fps, resolution = res['fps'], res['resolution']
+        for i in range(flight.numCam):
+            cam = Camera(K=None if np.isnan(K[i]).any() else K[i], d=None if np.isnan(d[i]).any() else d[i],
+                         R=None if np.isnan(R[i]).any() else R[i], t=None if np.isnan(t[i]).any() else t[i],
+                         fps=fps[i], resolution=[int(r) for r in resolution[i]])
+            if cam.K is not None and cam.R is not None and cam.t is not None:
+                cam.compose()
+            flight.addCamera(cam)
+
+        flight.detections = [np.empty((3,0)) for i in range(flight.numCam)]
+        flight.detections_global = [np.empty((3,0)) for i in range(flight.numCam)]
+        flight.spline = res.spline()
+        flight.traj = res['traj']
+        flight.out = res.out()
+
+    return flight
@@ -0,0 +1,202 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Ingestion of live detection streams of multiple cameras
+#
+# Each camera connects over TCP or a Unix socket and sends a header line "cam <id>",
+# followed by one detection per line as "frame x y", the same columns as loaded by create_scene.
+
+import asyncio
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed-size buffer of detections of one camera in the global timeline
+
+    Detections are released in the order they were added. If the buffer is full, the oldest detection is dropped
+
+    Members
+    -------
+    data : rows are timestamp, frame, x, y
+    dropped : number of detections that were dropped because the buffer was full
+    """
+
+    def __init__(self, size):
+        self.data = np.zeros((4, size))
+        self.start = 0
+        self.count = 0
+        self.dropped = 0
+
+
+    def push(self, timestamp, frame, x, y):
+        size = self.data.shape[1]
+        if self.count == size:
+            self.start = (self.start + 1) % size
+            self.count -= 1
+            self.dropped += 1
+
+        self.data[:, (self.start + self.count) % size] = timestamp, frame, x, y
+        self.count += 1
+
+
+    def pop_until(self, watermark):
+        '''
+        Remove and return all detections up to the watermark
+        '''
+
+        idx = (self.start + np.arange(self.count)) % self.data.shape[1]
+        num = np.searchsorted(self.data[0, idx], watermark, side='right')
+
+        out = self.data[:, idx[:num]]
+        self.start = (self.start + num) % self.data.shape[1]
+        self.count -= num
+
+        return out
+
+
+class IngestServer:
+    """
+    Server that accepts one detection stream per camera and releases time-aligned batches
+
+    Frame indices are converted into the global timeline with alpha, beta and rs of a calibrated scene.
+    A batch contains all detections up to a watermark, which is the latest timestamp that every connected camera has passed.
+    If the ring buffer of a camera is full, reading of its stream pauses until the other cameras catch up, so the
+    sender is slowed down by the flow control of the socket. With drop, the oldest detection is dropped instead.
+    The camera with the lowest watermark has always released all its detections, so it is never paused.
+    If the number of streams is given, nothing is released before all of them have connected.
+    When a camera disconnects, its remaining detections are released as the others pass them. A camera that connects late only holds back the
+    detections after the watermark it joins at, its own older detections are released with the next batch.
+
+    Members
+    -------
+    buffers : ring buffer of each connected camera
+    watermark : latest timestamp received from each connected camera
+    dropped : number of detections that were dropped because a ring buffer was full
+    batches : queue of released batches, rows are timestamp, camera id, frame, x, y. None marks the end of all expected streams
+
+    Methods
+    -------
+    serve_tcp: accept streams on a TCP port
+    serve_unix: accept streams on a Unix socket
+    """
+
+    def __init__(self, scene, buffer_size=1024, num_streams=None, drop=False):
+        self.alpha, self.beta, self.rs = np.array(scene.alpha), np.array(scene.beta), np.array(scene.rs)
+        self.height = [cam.resolution[1] for cam in scene.cameras]
+        self.buffer_size = buffer_size
+        self.drop = drop
+
+        self.buffers = {}
+        self.watermark = {}
+        self.released = None
+        self.num_streams = num_streams
+        self.num_closed = 0
+        self.dropped = 0
+        self.batches = asyncio.Queue()
+        self.freed = asyncio.Event()
+
+
+    async def handle(self, reader, writer):
+        '''
+        Read the stream of a single camera
+        '''
+
+        header = (await reader.readline()).split()
+        assert len(header) == 2 and header[0] == b'cam', 'Stream must start with "cam <id>"'
+        cam_id = int(header[1])
+
+        buffer = self.buffers[cam_id] = RingBuffer(self.buffer_size)
+        self.watermark[cam_id] = -np.inf
+
+        try:
+            async for line in reader:
+                if not line.strip():
+                    continue
+                frame, x, y = map(float, line.split())
+                timestamp = self.alpha[cam_id] * (frame + self.rs[cam_id] * y / self.height[cam_id]) + self.beta[cam_id]
+
+                while not self.drop and buffer.count == self.buffer_size:
+                    self.freed.clear()
+                    await self.freed.wait()
+
+                buffer.push(timestamp, frame, x, y)
+                self.watermark[cam_id] = max(self.watermark[cam_id], timestamp)
+                self.release()
+        finally:
+            writer.close()
+            del self.watermark[cam_id]
+            self.num_closed += 1
+            self.release()
+
+
+    def release(self):
+        '''
+        Release all detections up to the watermark of the connected cameras as one batch
+
+        Closed cameras no longer hold back the watermark, their remaining detections are released in order with the others
+        '''
+
+        if self.num_streams is not None and len(self.watermark) + self.num_closed < self.num_streams:
+            watermark = -np.inf
+        else:
+            watermark = min(self.watermark.values()) if self.watermark else np.inf
+        if watermark == self.released:
+            return
+
+        batch = []
+        for cam_id, buffer in list(self.buffers.items()):
+            data = buffer.pop_until(watermark)
+            if data.shape[1]:
+                batch.append(np.vstack((data[0], np.full(data.shape[1], cam_id), data[1:])))
+            if cam_id not in self.watermark and not buffer.count:
+                self.dropped += buffer.dropped
+                del self.buffers[cam_id]
+
+        if batch:
+            self.freed.set()
+            batch = np.hstack(batch)
+            self.batches.put_nowait(batch[:, np.argsort(batch[0], kind='stable')])
+        self.released = watermark
+
+        if not self.watermark and self.num_closed == self.num_streams:
+            self.batches.put_nowait(None)
+
+
+    async def serve_tcp(self, host='127.0.0.1', port=0):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+    async def serve_unix(self, path):
+        return await asyncio.start_unix_server(self.handle, path)
+
+
+async def replay(path, cam_id, host='127.0.0.1', port=None, unix=None, speed=0, fps=None, num_detections=None):
+    '''
+    Stand-in client that sends the detections of a detection file as the stream of one camera
+
+    Detections are sent as fast as possible, or at speed times the frame rate fps if speed is given
+    '''
+
+    if unix is not None:
+        reader, writer = await asyncio.open_unix_connection(unix)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    detect = np.loadtxt(path, usecols=(2,0,1))[:num_detections]
+    writer.write('cam {}\n'.format(cam_id).encode())
+
+    for k, (frame, x, y) in enumerate(detect):
+        writer.write('{} {} {}\n'.format(frame, x, y).encode())
+        if speed and k + 1 < len(detect):
+            await writer.drain()
+            await asyncio.sleep((detect[k+1,0] - frame) / fps / speed)
+        elif k % 256 == 0:
+            await writer.drain()
+
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+    return len(detect)
@@ -0,0 +1,233 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Reconstruction of a flight from its config file, as a sequence of named stages
+import functools
+import numpy as np
+import os
+import pickle
+from datetime import datetime
+from reconstruction import common
+from analysis.compare_gt import align_gt
+from tools import visualization as vis
+from tools import smoothing
+from tools import result
+from tools.cache import StageCache
+
+
+class Pipeline:
+    """
+    Reconstruction of flights from their config files
+
+    A flight is reconstructed in the stages create_scene, cut_detection, init_sync, time_shift, detection_to_global, init_traj and
+    traj_to_spline, followed by bundle_adjust_<n> and add_camera_<n> for each number of cameras n of the incremental reconstruction.
+    Stages are cached if "path_cache" is set, see tools.cache. After each stage and after the output is written, every callback is called
+    as callback(name, scene).
+
+    The pipeline keeps no state of a flight, so one instance can reconstruct many flights in the same process.
+
+    Members
+    -------
+    headless : don't show the trajectory at the end
+    callbacks : functions that are called after each stage
+
+    Methods
+    -------
+    run: reconstruct a flight and write its output
+    """
+
+    def __init__(self, headless=False, callbacks=None):
+        self.headless = headless
+        self.callbacks = list(callbacks or [])
+
+
+    def run(self, path_config, resume=False, settings=None):
+        '''
+        Reconstruct the flight of a config file and write its output. Returns the scene
+
+        If resume is True, the reconstruction continues from the last checkpoint, see Scene.save_checkpoint.
+        Settings given as a dict replace those of the config
+        '''
+
+        # Stages are cached in "path_cache" if it is set, so that a rerun only computes the stages whose inputs or settings changed
+        cache = StageCache(path_config)
+        cache.settings.update(settings or {})
+
+        # The state is saved after each camera is registered and bundle adjusted
+        path_checkpoint = cache.settings.get('path_checkpoint', cache.settings['path_output'] + '.checkpoint')
+
+        if resume:
+            # The checkpoint replaces the scene of the config, whose inputs are not loaded. Stages after it are run without caching
+            flight, cam_temp = common.load_checkpoint(path_checkpoint, settings=cache.settings)
+            cache.path, cache.scene = None, flight
+        else:
+            # Initialize a scene from the json template
+            self.stage(cache, 'create_scene', lambda scene: common.create_scene(path_config, config=cache.config))
+
+            # Truncate detections
+            self.stage(cache, 'cut_detection', lambda flight: flight.cut_detection(second=flight.settings['cut_detection_second']))
+
+            self.stage(cache, 'init_sync', self.init_sync)
+
+            # Compute time shift for each camera
+            self.stage(cache, 'time_shift', lambda flight: flight.time_shift())
+
+            # Convert raw detections into the global timeline
+            self.stage(cache, 'detection_to_global', lambda flight: flight.detection_to_global())
+
+            self.stage(cache, 'init_traj', self.init_traj)
+
+            # Convert discrete trajectory to spline representation
+            flight = self.stage(cache, 'traj_to_spline', lambda flight: flight.traj_to_spline(smooth_factor=flight.settings['smooth_factor']))
+
+            cam_temp = len(flight.sequence) if flight.settings.get('path_warm_start') else 2
+
+        '''---------------Incremental reconstruction----------------'''
+        start = datetime.now()
+        np.set_printoptions(precision=4)
+
+        while True:
+            # Cameras up to cam_temp are already bundle adjusted when resuming
+            if not resume:
+                flight = self.stage(cache, 'bundle_adjust_{}'.format(cam_temp), lambda flight: self.bundle_adjust(flight, cam_temp))
+
+                # Save the state after the BA of each camera
+                flight.save_checkpoint(path_checkpoint, cam_temp)
+            resume = False
+
+            num_end = flight.numCam if flight.find_order else len(flight.sequence)
+            if cam_temp == num_end:
+                print('\nTotal time: {}\n\n\n'.format(datetime.now()-start))
+                break
+
+            flight = self.stage(cache, 'add_camera_{}'.format(cam_temp), lambda flight: self.add_camera(flight, cam_temp))
+
+            print('\nTotal time: {}\n\n\n'.format(datetime.now()-start))
+            cam_temp += 1
+
+        self.output(flight)
+
+        # The checkpoint is only needed until the output is written
+        if os.path.isfile(path_checkpoint):
+            os.remove(path_checkpoint)
+
+        for callback in self.callbacks:
+            callback('output', flight)
+
+        return flight
+
+
+    def stage(self, cache, name, stage):
+        '''
+        Run a stage through the cache and call the callbacks. Returns the scene
+        '''
+
+        flight = cache.run(name, stage)
+        for callback in self.callbacks:
+            callback(name, flight)
+
+        return flight
+
+
+    @staticmethod
+    def init_sync(flight):
+        # Reuse the cameras of a previous result of the same rig, otherwise add prior alpha
+        if flight.settings.get('path_warm_start'):
+            flight.warm_start(flight.settings['path_warm_start'])
+        else:
+            flight.init_alpha()
+
+
+    @staticmethod
+    def init_traj(flight):
+        # Initialize the first 3D trajectory, from all cameras at once for a warm start
+        if flight.settings.get('path_warm_start'):
+            flight.triangulate_all(thres=flight.settings['thres_triangulation'])
+        else:
+            flight.init_traj(error=flight.settings['thres_Fmatix'])
+
+
+    @staticmethod
+    def bundle_adjust(flight, cam_temp):
+        '''
+        Bundle adjust the first cam_temp cameras, before and after outlier removal
+        '''
+
+        print('\n----------------- Bundle Adjustment with {} cameras -----------------'.format(cam_temp))
+        print('\nMean error of each camera before BA:   ', np.asarray([np.mean(flight.error_cam(x)) for x in flight.sequence[:cam_temp]]))
+
+        # Bundle adjustment, in temporal shards for long flights if "ba_window" is set, or coarse-to-fine if "ba_pyramid" is set
+        if flight.settings.get('ba_window'):
+            bundle_adjust = flight.BA_sharded
+        elif flight.settings.get('ba_pyramid'):
+            bundle_adjust = flight.BA_pyramid
+        else:
+            bundle_adjust = flight.BA
+
+        # Cap the number of detections of each camera per knot span of the spline, only within the BA
+        if flight.settings.get('max_detections_per_knot'):
+            bundle_adjust = functools.partial(flight.BA_decimated, bundle_adjust=bundle_adjust)
+
+        bundle_adjust(cam_temp, rs=flight.settings['rolling_shutter'],\
+            motion_reg=flight.settings['motion_reg'],\
+            motion_weights=flight.settings['motion_weights'],\
+            rs_bounds=flight.settings['rs_bounds'])
+
+        print('\nMean error of each camera after first BA:    ', np.asarray([np.mean(flight.error_cam(x)) for x in flight.sequence[:cam_temp]]))
+
+        flight.remove_outliers(flight.sequence[:cam_temp],thres=flight.settings['thres_outlier'])
+
+        # Bundle adjustment after outlier removal
+        bundle_adjust(cam_temp, rs=flight.settings['rolling_shutter'],\
+            motion_reg=flight.settings['motion_reg'],\
+            motion_weights=flight.settings['motion_weights'],\
+            rs_bounds=flight.settings['rs_bounds'])
+
+        print('\nMean error of each camera after second BA:    ', np.asarray([np.mean(flight.error_cam(x)) for x in flight.sequence[:cam_temp]]))
+
+
+    @staticmethod
+    def add_camera(flight, cam_temp):
+        '''
+        Register the next camera and triangulate its new points
+        '''
+
+        # Select the next camera if not pre-defined
+        flight.select_most_overlap()
+
+        # Add the next camera and get its pose
+        flight.get_camera_pose(flight.sequence[cam_temp])
+
+        # Triangulate new points and update the 3D spline
+        flight.triangulate(flight.sequence[cam_temp], flight.sequence[:cam_temp], thres=flight.settings['thres_triangulation'],
+                           factor_t2s=flight.settings['smooth_factor'], factor_s2t=flight.settings['sampling_rate'])
+        flight.traj_len = []
+
+
+    def output(self, flight):
+        '''
+        Sample and smooth the final trajectory, align it with the ground truth and write the output
+        '''
+
+        flight.spline_to_traj(sampling_rate=1)
+
+        # Smooth the trajectory with a Kalman filter and an RTS smoother
+        traj = smoothing.smooth_from_settings(flight.traj, flight.settings)[1:]
+
+        # Visualize the 3D trajectory
+        if not self.headless:
+            vis.show_trajectory_3D(traj,line=False)
+        flight.out  = {'reconst_tran' : flight.traj[1:]}
+        # Align with the ground truth data if available
+        if flight.gt:
+            flight.out = align_gt(flight, flight.gt['frequency'], flight.gt['filepath'], visualize=False)
+
+        # Write a compact result file if the output path ends with .npz, otherwise pickle the scene
+        if flight.settings['path_output'].endswith('.npz'):
+            result.save_result(flight.settings['path_output'], flight, traj=flight.settings.get('save_traj', False))
+        else:
+            with open(flight.settings['path_output'],'wb') as f:
+                pickle.dump(flight, f)
+
+        print('Finished!')
@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Incremental bundle adjustment of a growing flight in a sliding time window
+import copy
+import numpy as np
+from reconstruction.common import Scene
+
+
+class SlidingWindowBA:
+    """
+    Bundle adjustment of a flight whose detections arrive over time, for a camera rig that has been calibrated by a full reconstruction
+
+    The working scene only holds the detections and splines of the active window, which covers the latest window seconds of the global timeline.
+    On each update, the window is moved to the latest detections. Splines before the window are frozen and its detections are dropped.
+    New points after the end of the active splines are triangulated from all camera pairs, the splines of the window are refitted to them
+    together with points sampled from the previous splines, and BA is run for a few iterations on the window only.
+    Since the window has a bounded length, the cost of an update does not grow with the length of the flight.
+
+    Cameras, sync and rs parameters are kept fixed unless opt_cam is set.
+
+    Members
+    -------
+    scene : working scene with the detections and splines of the active window
+    window : length of the active window in the global timeline
+    start : start of the active window
+    frozen : splines and intervals before the window, which are no longer optimized
+
+    Methods
+    -------
+    add_detections: queue raw detections of a camera
+    update: move the window, extend the splines and optimize the window
+    spline: splines of the whole flight
+    """
+
+    def __init__(self, rig, window, max_iter=3, opt_cam=False, thres=None):
+        scene = Scene()
+        for key in ['numCam', 'cf', 'sequence', 'ref_cam']:
+            setattr(scene, key, copy.copy(getattr(rig, key)))
+        scene.settings = dict(rig.settings)
+        scene.cameras = copy.deepcopy(rig.cameras)
+        scene.alpha, scene.beta, scene.rs = np.array(rig.alpha, dtype=float), np.array(rig.beta, dtype=float), np.array(rig.rs, dtype=float)
+        scene.find_order = False
+        scene.detections = [np.empty((3,0)) for i in range(scene.numCam)]
+        scene.detections_global = [np.empty((3,0)) for i in range(scene.numCam)]
+        scene.spline = {'tck': [], 'int': np.empty((2,0))}
+        self.scene = scene
+
+        self.window = window
+        self.max_iter = max_iter
+        self.opt_cam = opt_cam
+        self.thres = scene.settings['thres_triangulation'] if thres is None else thres
+
+        self.start = -np.inf
+        self.frozen = {'tck': [], 'int': []}
+        self.pending = [[] for i in range(scene.numCam)]
+
+
+    def add_detections(self, cam_id, detections):
+        '''
+        Queue raw detections of a camera, rows are frame, x, y as in create_scene
+
+        Detections of each camera must arrive in order of their frames
+        '''
+
+        if cam_id in self.scene.sequence and detections.shape[1]:
+            self.pending[cam_id].append(np.asarray(detections, dtype=float).reshape(3,-1))
+
+
+    def freeze(self, start):
+        '''
+        Move the splines before start out of the working scene
+
+        A spline that crosses start is frozen up to start, the rest of it stays active
+        '''
+
+        tck, interval = self.scene.spline['tck'], self.scene.spline['int']
+        for i in range(interval.shape[1]):
+            if interval[0,i] < start:
+                self.frozen['tck'].append(tck[i])
+                self.frozen['int'].append([interval[0,i], min(interval[1,i], np.nextafter(start, -np.inf))])
+
+        active = interval[1] >= start
+        self.scene.spline = {'tck': [tck[i] for i in np.where(active)[0]],
+                             'int': np.vstack((np.maximum(interval[0,active], start), interval[1,active]))}
+
+
+    def update(self):
+        '''
+        Add the queued detections and optimize the active window
+
+        Returns the result of BA, or None if the window can't be optimized yet
+        '''
+
+        scene, cams = self.scene, self.scene.sequence
+        settings = scene.settings
+
+        for i in cams:
+            if self.pending[i]:
+                scene.detections[i] = np.hstack([scene.detections[i]] + self.pending[i])
+                self.pending[i] = []
+        scene.detection_to_global(cams)
+
+        latest = [scene.detections_global[i][0,-1] for i in cams if scene.detections_global[i].shape[1]]
+        if not latest:
+            return None
+
+        # Move the window and drop everything before it
+        self.start = max(self.start, max(latest) - self.window)
+        self.freeze(self.start)
+        for i in cams:
+            keep = scene.detections_global[i][0] >= self.start
+            scene.detections[i] = scene.detections[i][:,keep]
+            scene.detections_global[i] = scene.detections_global[i][:,keep]
+        scene.ba_layout = None
+
+        # Points sampled from the active splines and new points after their end
+        if scene.spline['int'].shape[1]:
+            end = scene.spline['int'][1,-1]
+            traj = scene.spline_to_traj(sampling_rate=settings['sampling_rate'])
+        else:
+            end = -np.inf
+            traj = np.empty((4,0))
+        X = scene.triangulate_all(thres=self.thres)
+        traj = np.hstack((traj, X[:, X[0] > end]))
+        _, idx = np.unique(traj[0], return_index=True)
+        scene.traj = traj[:, idx]
+
+        if scene.traj.shape[1] < 4:
+            scene.spline = {'tck': [], 'int': np.empty((2,0))}
+            return None
+        scene.traj_to_spline(smooth_factor=settings['smooth_factor'])
+        if not scene.spline['int'].shape[1]:
+            return None
+
+        # A few iterations on the window only
+        return scene.BA(len(cams), max_iter=self.max_iter, rs=settings['rolling_shutter'], motion_reg=settings['motion_reg'],
+                        motion_weights=settings['motion_weights'], rs_bounds=settings['rs_bounds'], opt_cam=self.opt_cam)
+
+
+    def spline(self):
+        '''
+        Splines of the whole flight in the format of Scene.spline, frozen ones followed by the active ones
+        '''
+
+        interval = np.array(self.frozen['int']).reshape(-1,2).T
+        return {'tck': self.frozen['tck'] + self.scene.spline['tck'],
+                'int': np.hstack((interval, self.scene.spline['int']))}
@@ -0,0 +1,168 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Online 3D tracking with a calibrated camera rig
+import numpy as np
+from tools import smoothing
+
+
+class Tracker:
+    """
+    Online 3D tracker for a camera rig that has been calibrated by a full reconstruction
+
+    Detections are added one at a time in arrival order. Each detection is converted into the global timeline with the
+    stored sync parameters, and triangulated with the latest detections of the other cameras within a time window.
+    Triangulated points are filtered with a Kalman filter, using the same motion models as tools.smoothing.
+
+    Each camera keeps only a fixed number of recent detections, so time and memory per detection are bounded.
+
+    Members
+    -------
+    cameras : ids of the calibrated cameras
+    P : projection matrices of the calibrated cameras
+    window : maximum time difference between detections that are triangulated together
+    buffer : ring buffer of recent detections of each camera, rows are timestamp, x, y
+    state : filtered state of each axis (s x 3), where the first row is the position
+
+    Methods
+    -------
+    add_detection: add a detection and return the filtered 3D position at its timestamp
+    add_global: add a detection that is already in the global timeline
+    """
+
+    def __init__(self, scene, window=1, buffer_size=32, model=None, q=None, r=None):
+        settings = scene.settings
+        self.cameras = list(scene.sequence)
+        self.P = {i: scene.cameras[i].P.copy() for i in self.cameras}
+        self.undist = {i: scene.cameras[i].undist_point for i in self.cameras} if settings['undist_points'] else None
+        self.height = {i: scene.cameras[i].resolution[1] for i in self.cameras}
+        self.alpha, self.beta, self.rs = np.array(scene.alpha), np.array(scene.beta), np.array(scene.rs)
+
+        self.window = window
+        self.model = settings.get('kalman_model', 'cv') if model is None else model
+        self.q = settings.get('kalman_process_noise', 0.1) if q is None else q
+        self.r = settings.get('kalman_measurement_noise', 2.5) if r is None else r
+
+        self.buffer = {i: np.full((3, buffer_size), np.nan) for i in self.cameras}
+        self.head = {i: 0 for i in self.cameras}
+
+        self.state, self.cov, self.time = None, None, None
+
+
+    def to_global(self, cam_id, frame, y):
+        '''
+        Convert the frame index of a detection into the global timeline
+        '''
+
+        return self.alpha[cam_id] * (frame + self.rs[cam_id] * y / self.height[cam_id]) + self.beta[cam_id]
+
+
+    def views(self, cam_id, timestamp):
+        '''
+        Positions of the detections of all other cameras at the given timestamp
+
+        Detections are linearly interpolated if the timestamp lies between two of them, otherwise the nearest one within the window is taken
+        '''
+
+        views = []
+        for i in self.cameras:
+            if i == cam_id:
+                continue
+
+            # Filled entries of the ring buffer in temporal order
+            ts = self.buffer[i][0]
+            order = np.flatnonzero(~np.isnan(ts))
+            order = order[np.argsort(ts[order])]
+            ts, det = ts[order], self.buffer[i][1:,order]
+
+            # Last detection at or before the timestamp and first one at or after it, if they exist
+            before = np.searchsorted(ts, timestamp, side='right') - 1
+            after = np.searchsorted(ts, timestamp, side='left')
+            has_before, has_after = before >= 0, after < len(ts)
+
+            if has_before and has_after and ts[after] - ts[before] <= self.window:
+                t0, t1 = ts[before], ts[after]
+                w = (timestamp - t0) / (t1 - t0) if t1 > t0 else 0
+                views.append((i, (1-w) * det[:,before] + w * det[:,after]))
+            else:
+                near = [j for j, exists in [(before, has_before), (after, has_after)] if exists and abs(ts[j] - timestamp) <= self.window]
+                if near:
+                    j = min(near, key=lambda j: abs(ts[j] - timestamp))
+                    views.append((i, det[:,j]))
+
+        return views
+
+
+    def triangulate(self, points):
+        '''
+        Linear triangulation of a 3D point from multiple views, given as pairs of camera id and 2D point
+        '''
+
+        A = np.vstack([[x[0]*self.P[i][2] - self.P[i][0], x[1]*self.P[i][2] - self.P[i][1]] for i, x in points])
+        X = np.linalg.svd(A)[2][-1]
+
+        return X[:3] / X[3]
+
+
+    def filter(self, timestamp, X):
+        '''
+        Kalman filter update with a triangulated 3D point
+        '''
+
+        if self.state is None:
+            F, Q = smoothing.motion_model([0], self.model, self.q)
+            self.state = np.zeros((F.shape[1], 3))
+            self.state[0] = X
+            self.cov = np.diag([self.r] + [1e6]*(F.shape[1]-1))
+        else:
+            F, Q = smoothing.motion_model([timestamp - self.time], self.model, self.q)
+            self.state = F[0] @ self.state
+            self.cov = F[0] @ self.cov @ F[0].T + Q[0]
+            gain = self.cov[:,0] / (self.cov[0,0] + self.r)
+            self.state = self.state + np.outer(gain, X - self.state[0])
+            self.cov = self.cov - np.outer(gain, self.cov[0])
+
+        self.time = timestamp
+
+        return self.state[0]
+
+
+    def add_detection(self, cam_id, frame, x, y):
+        '''
+        Add a detection of a camera
+
+        Returns the timestamp and the filtered 3D position, or None if there are not enough views or the detection is older than the last estimate
+        '''
+
+        if cam_id not in self.buffer:
+            return None
+
+        return self.add_global(cam_id, self.to_global(cam_id, frame, y), x, y)
+
+
+    def add_global(self, cam_id, timestamp, x, y):
+        '''
+        Add a detection of a camera whose timestamp is already in the global timeline, e.g. from the ingestion server
+
+        Returns the same as add_detection
+        '''
+
+        if cam_id not in self.buffer:
+            return None
+
+        if self.undist is not None:
+            x, y = self.undist[cam_id](np.array([[x],[y]], dtype=float))[:,0]
+        self.buffer[cam_id][:,self.head[cam_id]] = timestamp, x, y
+        self.head[cam_id] = (self.head[cam_id] + 1) % self.buffer[cam_id].shape[1]
+
+        if self.time is not None and timestamp < self.time:
+            return None
+
+        views = self.views(cam_id, timestamp)
+        if not views:
+            return None
+
+        X = self.triangulate([(cam_id, np.array([x, y]))] + views)
+
+        return timestamp, self.filter(timestamp, X)
@@ -0,0 +1,115 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Load test of the ingestion server: each calibrated camera replays its detection file as a separate stream,
+# and the released time-aligned batches are fed into the online tracker and optionally into the sliding window BA
+#
+# Usage: python stream.py <config.json> [<calibrated result>]
+# The calibrated result defaults to the output path of the config
+
+import asyncio
+import json
+import numpy as np
+import sys
+import time
+from reconstruction import common
+from reconstruction.ingest import IngestServer, replay
+from reconstruction.streaming import SlidingWindowBA
+from reconstruction.tracking import Tracker
+
+async def run():
+    server = IngestServer(rig, buffer_size=settings.get('stream_buffer', 1024), num_streams=len(rig.sequence),
+                          drop=settings.get('stream_drop', False))
+    tracker = Tracker(rig, window=settings.get('track_window', 1), buffer_size=settings.get('track_buffer', 32))
+
+    # Sliding window BA, updated every step on the global timeline
+    window = settings.get('stream_ba_window')
+    if window:
+        sliding = SlidingWindowBA(rig, window, max_iter=settings.get('stream_ba_iter', 3))
+        step = settings.get('stream_ba_step', window/4)
+        t_update, time_update = -np.inf, []
+
+    unix = settings.get('stream_socket', None)
+    if unix is not None:
+        listener = await server.serve_unix(unix)
+        port = None
+    else:
+        listener = await server.serve_tcp(port=settings.get('stream_port', 0))
+        port = listener.sockets[0].getsockname()[1]
+
+    speed = settings.get('stream_speed', 0)
+    clients = [replay(config['necessary inputs']['path_detections'][i], i, port=port, unix=unix,
+                      speed=speed, fps=rig.cameras[i].fps, num_detections=settings.get('num_detections'))
+               for i in rig.sequence]
+
+    start = time.perf_counter()
+    sent = asyncio.gather(*clients)
+
+    num_batches, num_detections, traj = 0, 0, []
+    while True:
+        batch = await server.batches.get()
+        if batch is None:
+            break
+        num_batches += 1
+        num_detections += batch.shape[1]
+        for t, cam_id, _, x, y in batch.T:
+            out = tracker.add_global(int(cam_id), t, x, y)
+            if out is not None:
+                traj.append(out[0])
+
+        if window:
+            for i in np.unique(batch[1]).astype(int):
+                sliding.add_detections(i, batch[2:, batch[1]==i])
+            if batch[0,-1] >= t_update + step:
+                t0 = time.perf_counter()
+                sliding.update()
+                time_update.append(time.perf_counter() - t0)
+                t_update = batch[0,-1]
+
+    total = time.perf_counter() - start
+    num_sent = sum(await sent)
+    listener.close()
+    await listener.wait_closed()
+
+    print('{} detections sent, {} released in {} batches, {} dropped'.format(num_sent, num_detections, num_batches, server.dropped))
+    print('Throughput: {:.0f} detections/s'.format(num_detections / total))
+    print('{} positions, time-ordered: {}'.format(len(traj), bool(np.all(np.diff(traj) >= 0)) if traj else True))
+
+    if window:
+        sliding.update()
+        if time_update:
+            print('{} BA updates, time per update: mean {:.3f} s, max {:.3f} s, last {:.3f} s'.format(
+                  len(time_update), np.mean(time_update), np.max(time_update), time_update[-1]))
+        else:
+            print('No BA updates')
+
+        # Compare with the offline reconstruction, if the sliding window has a spline
+        online = sliding.spline()
+        if not online['int'].shape[1]:
+            print('The sliding window has no spline to compare with the offline trajectory')
+            return
+
+        rig.spline, spline = online, rig.spline
+        online = rig.sample_spline(np.arange(rig.spline['int'][0,0], rig.spline['int'][1,-1]))
+        rig.spline = spline
+        offline = rig.sample_spline(online[0])
+        online = online[:,np.isin(online[0], offline[0])]
+        print('Mean distance of the sliding window splines to the offline trajectory: {:.3g}'.format(
+              np.mean(np.linalg.norm(online[1:] - offline[1:], axis=0))))
+
+# Worker processes of parallel BA import this module, so the load test only runs in the main process
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print( "Please provide a path to a proper config file")
+        sys.exit()
+
+    with open(sys.argv[1], 'r') as file:
+        config = json.load(file)
+    settings = config['settings']
+
+    # Calibrated rig from a previous reconstruction
+    path_result = sys.argv[2] if len(sys.argv) > 2 else settings['path_output']
+    rig = common.load_scene(path_result)
+
+    asyncio.run(run())
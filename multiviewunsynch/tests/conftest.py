@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Synthetic flights for the tests
+#
+# A drone flies a smooth 3D curve in front of a ring of five unsynchronized cameras with different frame rates.
+# Detections are projected with pixel noise and a few outliers, and each camera misses a few seconds of the flight.
+
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reconstruction import common
+from reconstruction.pipeline import Pipeline
+
+
+def write_flight(path, duration=60., seed=0):
+    '''
+    Write the detections, calibrations and config of a synthetic flight into a directory. Returns the path of the config
+    '''
+
+    rng = np.random.default_rng(seed)
+    fps = [30, 25, 60, 30, 29.97]
+    offset = [0, 1.3, -0.7, 2.1, 0.4]
+    K = np.array([[1500,0,960],[0,1500,540],[0,0,1.]])
+
+    def position(t):
+        return np.array([20*np.sin(0.2*t), 15*np.cos(0.13*t), 10+3*np.sin(0.3*t)])
+
+    corresponding_frames = []
+    for i, (f, o) in enumerate(zip(fps, offset)):
+        # Cameras on a circle, looking at its center
+        ang = 2*np.pi*i/len(fps)
+        c = np.array([60*np.cos(ang), 60*np.sin(ang), 2.])
+        z = -c/np.linalg.norm(c)
+        x = np.cross(z,[0,0,1.])
+        x /= np.linalg.norm(x)
+        R = np.vstack((x, np.cross(z,x), z))
+
+        frames = np.arange(int(-o*f)+5, int((duration-o)*f)-5)
+        t = o + frames/f
+        keep = ~((t > 20+3*i) & (t < 23+3*i))
+        frames, t = frames[keep], t[keep]
+
+        p = K @ (R @ (position(t) - c[:,None]))
+        p = p[:2]/p[2] + rng.normal(0, 0.5, (2,len(t)))
+        p[:, rng.choice(len(t), 5, replace=False)] += 80
+
+        np.savetxt(os.path.join(path, 'cam{}.txt'.format(i)), np.vstack((p, frames)).T, fmt='%.4f')
+        with open(os.path.join(path, 'cam{}.json'.format(i)), 'w') as file:
+            json.dump({'K-matrix': K.tolist(), 'distCoeff': [0,0,0,0,0], 'fps': f, 'resolution': [1920,1080]}, file)
+        corresponding_frames.append(-o*f)
+
+    config = {'necessary inputs': {'path_detections': [os.path.join(path, 'cam{}.txt'.format(i)) for i in range(len(fps))],
+                                   'path_cameras': [os.path.join(path, 'cam{}.json'.format(i)) for i in range(len(fps))],
+                                   'corresponding_frames': corresponding_frames},
+              'settings': {'num_detections': 100000, 'opt_calib': False, 'cf_exact': True, 'undist_points': True, 'rolling_shutter': True,
+                           'init_rs': [0,0,0,0,0], 'motion_type': 'F', 'motion_reg': True, 'motion_weights': 1e2, 'rs_bounds': False,
+                           'cut_detection_second': 0.5, 'camera_sequence': [], 'ref_cam': 0, 'thres_Fmatix': 30, 'thres_PnP': 30,
+                           'thres_outlier': 10, 'thres_triangulation': 20, 'smooth_factor': [10,20], 'sampling_rate': 0.5,
+                           'path_output': os.path.join(path, 'result.pkl')}}
+    path_config = os.path.join(path, 'config.json')
+    with open(path_config, 'w') as file:
+        json.dump(config, file)
+
+    return path_config
+
+
+def initial_scene(path_config):
+    '''
+    Scene of a config with the first two cameras synchronized and an initial spline, ready for the first BA
+    '''
+
+    np.random.seed(0)
+    flight = common.create_scene(path_config)
+    flight.cut_detection(second=flight.settings['cut_detection_second'])
+    Pipeline.init_sync(flight)
+    flight.time_shift()
+    flight.detection_to_global()
+    Pipeline.init_traj(flight)
+    flight.traj_to_spline(smooth_factor=flight.settings['smooth_factor'])
+
+    return flight
+
+
+@pytest.fixture(scope='session')
+def flight_config(tmp_path_factory):
+    return write_flight(str(tmp_path_factory.mktemp('flight')))
+
+
+@pytest.fixture(scope='session')
+def flight_scene(flight_config):
+    return initial_scene(flight_config)
@@ -0,0 +1,40 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import copy
+
+import numpy as np
+
+from reconstruction.pipeline import Pipeline
+
+
+def mean_error(flight, num_cam):
+    return np.mean(np.concatenate([flight.error_cam(i) for i in flight.sequence[:num_cam]]))
+
+
+def test_sharded_ba_matches_joint_ba(flight_scene):
+    joint, sharded = copy.deepcopy(flight_scene), copy.deepcopy(flight_scene)
+    sharded.settings = dict(sharded.settings, ba_window=500, ba_overlap=100)
+
+    Pipeline.bundle_adjust(joint, 2)
+    Pipeline.bundle_adjust(sharded, 2)
+
+    # The flight spans several windows
+    interval = sharded.spline['int']
+    assert interval[1,-1] - interval[0,0] > 3 * 500
+
+    assert mean_error(sharded, 2) < 1.1 * mean_error(joint, 2)
+
+
+def test_pyramid_refines_with_fewer_evaluations(flight_scene):
+    plain, pyramid = copy.deepcopy(flight_scene), copy.deepcopy(flight_scene)
+    kwargs = dict(rs=flight_scene.settings['rolling_shutter'], motion_reg=flight_scene.settings['motion_reg'],
+                  motion_weights=flight_scene.settings['motion_weights'], rs_bounds=flight_scene.settings['rs_bounds'])
+
+    res_plain = plain.BA(2, **kwargs)
+    res_full = pyramid.BA_pyramid(2, factors=[4], **kwargs)
+
+    # Only the last BA of the pyramid runs on all detections
+    assert res_full.nfev < res_plain.nfev
+    assert res_full.cost < 1.05 * res_plain.cost
@@ -0,0 +1,38 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import copy
+
+import numpy as np
+
+from reconstruction.pipeline import Pipeline
+from tools import result
+
+
+def write_output(flight_scene, path, **settings):
+    flight = copy.deepcopy(flight_scene)
+    flight.settings = dict(flight.settings, path_output=path, **settings)
+    Pipeline(headless=True).output(flight)
+    return flight
+
+
+def test_default_result_has_no_dense_trajectory(flight_scene, tmp_path):
+    path = str(tmp_path / 'result.npz')
+    flight = write_output(flight_scene, path)
+
+    with result.load_result(path) as res:
+        assert 'traj' not in res.keys()
+        assert not any(key.startswith('out_') and res[key].shape[-1] == flight.traj.shape[1] for key in res.keys())
+
+        # The trajectory is sampled from the splines instead
+        assert np.allclose(res['traj'], flight.traj)
+
+
+def test_result_with_trajectory(flight_scene, tmp_path):
+    path = str(tmp_path / 'result.npz')
+    flight = write_output(flight_scene, path, save_traj=True)
+
+    with result.load_result(path) as res:
+        assert np.array_equal(res['traj'], flight.traj)
+        assert np.array_equal(res.out()['reconst_tran'], flight.traj[1:])
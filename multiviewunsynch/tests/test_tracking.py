@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from types import SimpleNamespace
+
+import numpy as np
+
+from reconstruction.tracking import Tracker
+
+
+def rig(num_cam=2):
+    '''
+    Calibrated rig with identity sync, which is all the tracker reads from a scene
+    '''
+
+    camera = SimpleNamespace(P=np.hstack((np.eye(3), np.ones((3,1)))), resolution=[1920,1080], undist_point=None)
+    return SimpleNamespace(settings={'undist_points': False}, sequence=list(range(num_cam)), cameras=[camera]*num_cam,
+                           alpha=np.ones(num_cam), beta=np.zeros(num_cam), rs=np.zeros(num_cam))
+
+
+def fill(tracker, cam_id, timestamps):
+    for t in timestamps:
+        tracker.buffer[cam_id][:,tracker.head[cam_id]] = t, t, -t
+        tracker.head[cam_id] += 1
+
+
+def test_views_before_all_buffered_detections():
+    # Buffer that has wrapped around, so the first entry is not the oldest
+    tracker = Tracker(rig(), window=1)
+    fill(tracker, 1, [11, 12, 10])
+
+    # The nearest detection after the query is taken if it is within the window
+    views = tracker.views(0, 9.5)
+    assert len(views) == 1 and views[0][0] == 1
+    assert np.allclose(views[0][1], [10, -10])
+
+    assert tracker.views(0, 8) == []
+
+
+def test_views_after_all_buffered_detections():
+    tracker = Tracker(rig(), window=1)
+    fill(tracker, 1, [10, 11, 12])
+
+    assert np.allclose(tracker.views(0, 12.5)[0][1], [12, -12])
+    assert tracker.views(0, 14) == []
+
+
+def test_views_interpolate_unordered_buffer():
+    tracker = Tracker(rig(), window=1)
+    fill(tracker, 1, [12, 10, 11])
+
+    assert np.allclose(tracker.views(0, 10.25)[0][1], [10.25, -10.25])
+    assert np.allclose(tracker.views(0, 11)[0][1], [11, -11])
+
+
+def test_views_empty_buffer():
+    tracker = Tracker(rig(), window=1)
+
+    assert tracker.views(0, 10) == []
@@ -0,0 +1,192 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Content-addressed cache of the stages of a reconstruction
+#
+# The state after each stage is stored under a hash of the state before it, the name of the stage and the settings
+# the stage read, where settings that are paths of files are hashed by their content. The first key is a hash of the
+# input files and of the source code, so a rerun reuses every stage up to the first one whose inputs or settings changed.
+
+import glob
+import hashlib
+import json
+import numpy as np
+import os
+import pickle
+
+_MISSING = '<missing>'
+
+
+class TrackedSettings(dict):
+    """
+    Settings that record which keys are read
+
+    Members
+    -------
+    reads : keys read since the last call of track, None if reads are not recorded
+    """
+
+    reads = None
+
+    def track(self):
+        reads, self.reads = self.reads, set()
+        return reads
+
+
+    def untrack(self):
+        reads, self.reads = self.reads, None
+        return reads
+
+
+    def __getitem__(self, key):
+        if self.reads is not None:
+            self.reads.add(key)
+        return super().__getitem__(key)
+
+
+    def get(self, key, default=None):
+        if self.reads is not None:
+            self.reads.add(key)
+        return super().get(key, default)
+
+
+    def __contains__(self, key):
+        if self.reads is not None:
+            self.reads.add(key)
+        return super().__contains__(key)
+
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+def _hash(*values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _hash_inputs(value):
+    '''
+    Hash the inputs of a config, where existing files are hashed by their content
+    '''
+
+    if isinstance(value, dict):
+        return {key: _hash_inputs(v) for key, v in value.items()}
+    if isinstance(value, list):
+        return [_hash_inputs(v) for v in value]
+    if isinstance(value, str) and os.path.isfile(value):
+        with open(value, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    return value
+
+
+def _hash_source():
+    '''
+    Hash the source code of the project, so that results of other versions are not reused
+    '''
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sha = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(root, '**', '*.py'), recursive=True)):
+        with open(path, 'rb') as file:
+            sha.update(os.path.relpath(path, root).encode() + file.read())
+    return sha.hexdigest()
+
+
+class StageCache:
+    """
+    Cache of the state of a scene after each stage of the reconstruction
+
+    A stage is a function that changes the scene, or creates it if there is none yet. Settings of the scene are tracked while a stage
+    runs, and the keys it read are stored in a manifest of the stage. On the next run, the key of the stage is computed from the current
+    values of these keys. If the state for this key exists, it is loaded instead of running the stage.
+
+    The state of the random number generator is stored and restored with each scene. Without a cache directory, stages are just run.
+
+    Members
+    -------
+    path : cache directory, None if caching is disabled
+    config : the config file, whose settings are tracked
+    key : key of the current state
+    scene : the current scene
+
+    Methods
+    -------
+    run: run a stage or load its result
+    """
+
+    def __init__(self, path_config, path=None):
+        with open(path_config, 'r') as file:
+            self.config = json.load(file)
+        self.settings = TrackedSettings(self.config['settings'])
+        self.config['settings'] = self.settings
+        self.path = self.settings.get('path_cache') if path is None else path
+        self.scene = None
+
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+            inputs = {key: self.config.get(key) for key in ['necessary inputs', 'optional inputs']}
+            self.key = _hash(_hash_inputs(inputs), _hash_source())
+
+
+    def run(self, name, stage):
+        '''
+        Run a stage on the current scene, or load its result if it is cached. Returns the scene after the stage
+        '''
+
+        if not self.path:
+            self.scene = self._run(stage)
+            return self.scene
+
+        # Look up the stage with the keys it read before
+        path_manifest = os.path.join(self.path, '{}-{}.json'.format(name, self.key))
+        manifest = []
+        if os.path.isfile(path_manifest):
+            with open(path_manifest, 'r') as file:
+                manifest = json.load(file)
+
+        for reads in manifest:
+            key = self._key(name, reads)
+            path_state = os.path.join(self.path, key + '.pkl')
+            if os.path.isfile(path_state):
+                with open(path_state, 'rb') as file:
+                    state = pickle.load(file)
+                np.random.set_state(state['random_state'])
+                self.scene, self.key = state['scene'], key
+                self.scene.settings = self.settings
+                print('Stage {} is loaded from the cache\n'.format(name))
+                return self.scene
+
+        # Run the stage and record the keys it read
+        self.settings.track()
+        try:
+            self.scene = self._run(stage)
+        finally:
+            reads = sorted(self.settings.untrack())
+        key = self._key(name, reads)
+
+        ba_layout, self.scene.ba_layout = self.scene.ba_layout, None
+        try:
+            with open(os.path.join(self.path, key + '.pkl.tmp'), 'wb') as file:
+                pickle.dump({'scene': self.scene, 'random_state': np.random.get_state()}, file)
+            os.replace(os.path.join(self.path, key + '.pkl.tmp'), os.path.join(self.path, key + '.pkl'))
+        finally:
+            self.scene.ba_layout = ba_layout
+
+        if reads not in manifest:
+            with open(path_manifest, 'w') as file:
+                json.dump(manifest + [reads], file)
+        self.key = key
+
+        return self.scene
+
+
+    def _run(self, stage):
+        # Only the first stage creates the scene, others change it in place
+        scene = stage(self.scene)
+        return scene if self.scene is None else self.scene
+
+
+    def _key(self, name, reads):
+        # Settings that point to files, e.g. a warm start, are hashed by their content
+        return _hash(self.key, name, [(key, _hash_inputs(self.settings.get(key, _MISSING))) for key in reads])
@@ -0,0 +1,299 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Compact result files of a reconstruction
+#
+# A result is an uncompressed .npz archive with one array per field, so that each field is read from disk only
+# when it is accessed. Only numpy is needed to read it, and scipy to evaluate the splines with SplineTrajectory.
+#
+# Fields of schema version 2:
+#   version                     schema version
+#   settings                    settings of the config file as a JSON string
+#   sequence, ref_cam           reconstructed cameras in their order, and the reference camera
+#   K, d, R, t (numCam x ...)   camera parameters, NaN if unknown, distortion coefficients are padded with zeros
+#   fps, resolution             frame rate and resolution of each camera
+#   alpha, beta, rs, cf         sync and rolling shutter parameters
+#   spline_int (2 x s)          start and end of each spline interval
+#   spline_knots                knots of all splines, spline_knots_idx (s+1) marks where each spline starts
+#   spline_coeffs (3 x n)       coefficients of all splines, spline_coeffs_idx (s+1) marks where each spline starts
+#   spline_degree (s)           degree of each spline
+#   traj (4 x N)                optional discrete trajectory, rows are timestamp, x, y, z. If it is missing, it is sampled from the
+#                               splines at a sampling rate of 1
+#   residuals (5 x M)           camera id, frame, timestamp, x error and y error of each detection of the reconstructed cameras,
+#                               errors of detections outside of the splines are zero
+#   out_*                       arrays of the output dictionary, e.g. the alignment with the ground truth. The reconstructed
+#                               trajectory out_reconst_tran is sampled from the splines, so it is only written together with traj
+#
+# Version 1 always contains traj
+
+import json
+import numpy as np
+from scipy import interpolate
+
+SCHEMA_VERSION = 2
+
+# Entries of the output dictionary that are sampled from the splines
+TRAJ_OUT = ['reconst_tran']
+
+
+def save_result(path, scene, traj=True):
+    '''
+    Write the result of a reconstructed scene into a result file
+
+    The discrete trajectory and the entries of the output dictionary that are sampled from the splines are only written if traj is True
+    '''
+
+    numCam = scene.numCam
+    fields = {'version': np.array(SCHEMA_VERSION),
+              'settings': np.array(json.dumps(scene.settings)),
+              'sequence': np.array(scene.sequence, dtype=int),
+              'ref_cam': np.array(scene.ref_cam),
+              'alpha': np.asarray(scene.alpha, dtype=float),
+              'beta': np.asarray(scene.beta, dtype=float),
+              'rs': np.asarray(scene.rs, dtype=float),
+              'cf': np.asarray(scene.cf, dtype=float),
+              'fps': np.array([cam.fps for cam in scene.cameras], dtype=float),
+              'resolution': np.array([cam.resolution for cam in scene.cameras], dtype=float).reshape(numCam,2)}
+
+    # Camera parameters
+    num_dist = max([len(cam.d) for cam in scene.cameras if cam.d is not None], default=5)
+    for key, shape in [('K', (3,3)), ('R', (3,3)), ('t', (3,)), ('d', (num_dist,))]:
+        fields[key] = np.full((numCam,) + shape, np.nan)
+        for i, cam in enumerate(scene.cameras):
+            value = getattr(cam, key)
+            if value is not None:
+                value = np.asarray(value, dtype=float).ravel()
+                fields[key][i] = 0
+                fields[key][i].flat[:len(value)] = value
+
+    # Splines, concatenated with the start of each one
+    tck = scene.spline['tck']
+    fields['spline_int'] = np.asarray(scene.spline['int'], dtype=float).reshape(2,-1)
+    fields['spline_knots'] = np.concatenate([tck_i[0] for tck_i in tck]) if tck else np.empty(0)
+    fields['spline_knots_idx'] = np.cumsum([0] + [len(tck_i[0]) for tck_i in tck])
+    fields['spline_coeffs'] = np.hstack([np.asarray(tck_i[1]) for tck_i in tck]) if tck else np.empty((3,0))
+    fields['spline_coeffs_idx'] = np.cumsum([0] + [len(tck_i[1][0]) for tck_i in tck])
+    fields['spline_degree'] = np.array([tck_i[2] for tck_i in tck], dtype=int)
+
+    if traj:
+        fields['traj'] = np.asarray(scene.traj, dtype=float).reshape(4,-1) if len(scene.traj) else np.empty((4,0))
+
+    # Reprojection errors of each detection
+    residuals = [np.empty((5,0))]
+    if tck:
+        for i in scene.sequence:
+            error = np.split(scene.error_cam(i, mode='each'), 2)
+            residuals.append(np.vstack((np.full(scene.detections[i].shape[1], i), scene.detections[i][0],
+                                        scene.detections_global[i][0], error[0], error[1])))
+    fields['residuals'] = np.hstack(residuals)
+
+    for key, value in (scene.out or {}).items():
+        if key in TRAJ_OUT and not traj:
+            continue
+        value = np.asarray(value)
+        if value.dtype != object:
+            fields['out_' + key] = value
+
+    np.savez(path, **fields)
+
+
+class Result:
+    """
+    Lazy reader of a result file
+
+    Fields are read from the file only when they are accessed, e.g. result['traj'] reads only the trajectory, or samples it
+    from the splines if it was not written
+
+    Members
+    -------
+    version : schema version of the file
+
+    Methods
+    -------
+    settings: settings of the config file
+    spline: splines in the format of Scene.spline
+    trajectory: the splines as a SplineTrajectory
+    residuals: reprojection errors of the detections of a camera
+    out: the output dictionary
+    """
+
+    def __init__(self, path):
+        self.file = np.load(path, allow_pickle=False)
+        self.version = int(self.file['version'])
+        assert self.version <= SCHEMA_VERSION, \
+            'Result has schema version {}, but only versions up to {} are supported'.format(self.version, SCHEMA_VERSION)
+
+
+    def __getitem__(self, key):
+        if key == 'traj' and key not in self.file.files:
+            return self.trajectory().sample(sampling_rate=1)
+        return self.file[key]
+
+
+    def __contains__(self, key):
+        return key in self.file.files or key == 'traj'
+
+
+    def keys(self):
+        return self.file.files
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def settings(self):
+        return json.loads(str(self.file['settings']))
+
+
+    def spline(self):
+        '''
+        Splines in the format of Scene.spline, tck of each interval as returned by scipy.interpolate.splprep
+        '''
+
+        knots, idx_k = self.file['spline_knots'], self.file['spline_knots_idx']
+        coeffs, idx_c = self.file['spline_coeffs'], self.file['spline_coeffs_idx']
+        degree = self.file['spline_degree']
+
+        tck = [[knots[idx_k[i]:idx_k[i+1]], list(coeffs[:,idx_c[i]:idx_c[i+1]]), int(degree[i])] for i in range(len(degree))]
+
+        return {'tck': tck, 'int': self.file['spline_int']}
+
+
+    def trajectory(self):
+        return SplineTrajectory(self.spline())
+
+
+    def residuals(self, cam_id=None):
+        '''
+        Reprojection errors of the detections of a camera, rows are frame, timestamp, x error and y error
+
+        Without a camera, errors of all cameras are returned with the camera id in the first row
+        '''
+
+        residuals = self.file['residuals']
+        if cam_id is None:
+            return residuals
+
+        return residuals[1:, residuals[0]==cam_id]
+
+
+    def out(self):
+        return {key[4:]: self.file[key] for key in self.file.files if key.startswith('out_')}
+
+
+class SplineTrajectory:
+    """
+    3D trajectory given by the splines of a reconstruction, which can be evaluated at arbitrary timestamps
+
+    Each spline is converted once into a vector-valued scipy BSpline, derivatives are built when they are first needed.
+    Timestamps are assigned to the splines with a binary search, so all timestamps are evaluated in a single call.
+
+    Members
+    -------
+    interval : start and end of each spline (2 x s)
+    splines : BSpline of each interval in x, y and z
+
+    Methods
+    -------
+    evaluate: positions or derivatives at the given timestamps
+    velocity, acceleration: first and second derivatives at the given timestamps
+    sample: discrete trajectory at a constant sampling rate or at the given timestamps
+    """
+
+    def __init__(self, spline):
+        self.interval = np.asarray(spline['int'], dtype=float).reshape(2,-1)
+        self.splines = []
+        for knots, coeffs, k in spline['tck']:
+            knots, k = np.asarray(knots, dtype=float), int(k)
+            coeffs = np.asarray(coeffs, dtype=float)[:,:len(knots)-k-1]
+            self.splines.append(interpolate.BSpline(knots, coeffs.T, k, extrapolate=False))
+        self.derivatives = {0: self.splines}
+
+
+    def spline_ids(self, timestamp):
+        '''
+        Index of the spline of each timestamp, -1 if it lies outside of all intervals
+        '''
+
+        idx = np.searchsorted(self.interval[0], timestamp, side='right') - 1
+        if self.interval.shape[1]:
+            idx[timestamp > self.interval[1, np.maximum(idx,0)]] = -1
+        else:
+            idx[:] = -1
+
+        return idx
+
+
+    def evaluate(self, timestamp, der=0):
+        '''
+        Positions (der=0) or derivatives of order der at the given timestamps
+
+        Outputs are 3 x n, NaN for timestamps outside of all intervals
+        '''
+
+        timestamp = np.asarray(timestamp, dtype=float).ravel()
+        if der not in self.derivatives:
+            self.derivatives[der] = [spl.derivative(der) if der <= spl.k else None for spl in self.splines]
+        splines = self.derivatives[der]
+
+        out = np.full((3, len(timestamp)), np.nan)
+        idx = self.spline_ids(timestamp)
+        for i in np.unique(idx[idx>=0]):
+            mask = idx == i
+            out[:,mask] = splines[i](timestamp[mask]).T if splines[i] is not None else 0
+
+        return out
+
+
+    def velocity(self, timestamp):
+        return self.evaluate(timestamp, der=1)
+
+
+    def acceleration(self, timestamp):
+        return self.evaluate(timestamp, der=2)
+
+
+    def sample(self, sampling_rate=1, t=None):
+        '''
+        Discrete trajectory either with a constant sampling rate or at the given timestamps, see Scene.spline_to_traj
+
+        Timestamps outside of all intervals are dropped. Outputs are 3D points with the timestamp in the first row
+        '''
+
+        if t is not None:
+            timestamp = np.sort(np.asarray(t, dtype=float))
+        elif self.interval.shape[1]:
+            timestamp = np.arange(self.interval[0,0], self.interval[1,-1], sampling_rate)
+        else:
+            timestamp = np.empty(0)
+
+        timestamp = timestamp[self.spline_ids(timestamp) >= 0]
+
+        return np.vstack((timestamp, self.evaluate(timestamp)))
+
+
+def load_result(path):
+    '''
+    Open a result file, see Result
+    '''
+
+    return Result(path)
+
+
+def load_trajectory(path):
+    '''
+    Load only the splines of a result file as a SplineTrajectory
+    '''
+
+    with load_result(path) as result:
+        return result.trajectory()
@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Offline smoothing of discrete 3D trajectories with a Kalman filter and a Rauch-Tung-Striebel smoother
+import numpy as np
+
+
+def motion_model(dt, model='cv', q=0.1):
+    '''
+    Transition matrices and process noise of a single axis for each time step dt
+
+    Models: 'cv' (constant velocity, state is position and velocity) and 'ca' (constant acceleration, state is
+    position, velocity and acceleration), both driven by continuous white noise of intensity q
+
+    Outputs are arrays of shape (len(dt), n, n)
+    '''
+
+    dt = np.asarray(dt, dtype=float)[:,None,None]
+    one, zero = np.ones_like(dt), np.zeros_like(dt)
+
+    if model == 'cv':
+        F = np.block([[one, dt], [zero, one]])
+        Q = q * np.block([[dt**3/3, dt**2/2], [dt**2/2, dt]])
+    elif model == 'ca':
+        F = np.block([[one, dt, dt**2/2], [zero, one, dt], [zero, zero, one]])
+        Q = q * np.block([[dt**5/20, dt**4/8, dt**3/6], [dt**4/8, dt**3/3, dt**2/2], [dt**3/6, dt**2/2, dt]])
+    else:
+        raise ValueError('Motion model must be either "cv" or "ca"')
+
+    return F, Q
+
+
+def covariances(F, Q, P0, r):
+    '''
+    Predicted and filtered covariances of a Kalman filter that measures the first state with noise r
+
+    The recursion does not depend on the measurements. Within a run of equal time steps it converges to a steady state,
+    after which the remaining steps of the run are filled with it, so steps are only iterated while the covariance changes.
+
+    Outputs are arrays of shape (n x s x s), with n = len(F)+1
+    '''
+
+    num, s = len(F)+1, len(P0)
+    P_pred, P_filt = np.zeros((num,s,s)), np.zeros((num,s,s))
+    P_pred[0] = P0
+
+    # Start of the next run of equal transition matrices after each step
+    same = np.append(np.all(np.isclose(F[1:], F[:-1], rtol=1e-9, atol=0), axis=(1,2)), False)
+    run_end = np.arange(len(F))
+    for k in range(len(F)-2, -1, -1):
+        if same[k]:
+            run_end[k] = run_end[k+1]
+
+    k = 0
+    while k < num:
+        P_filt[k] = P_pred[k] - np.outer(P_pred[k,:,0], P_pred[k,0]) / (P_pred[k,0,0] + r)
+        if k == num-1:
+            break
+        P_pred[k+1] = F[k] @ P_filt[k] @ F[k].T + Q[k]
+
+        # Steady state within a run of equal steps, which lasts until step run_end[k]
+        if k and same[k-1] and np.max(np.abs(P_pred[k+1]-P_pred[k])) <= 1e-12 * np.max(np.abs(P_pred[k])):
+            end = run_end[k] + 1
+            P_pred[k+2:end+1] = P_pred[k+1]
+            P_filt[k+1:end] = P_filt[k]
+            k = end
+        else:
+            k += 1
+
+    return P_pred, P_filt
+
+
+def affine_scan(A, b):
+    '''
+    Solve the recursion x[k] = A[k] @ x[k-1] + b[k] with x[-1] = 0 for all k at once
+
+    A are (n x s x s) and b are (n x s x d). Consecutive maps are composed in log2(n) vectorized steps
+    '''
+
+    A, b = A.copy(), b.copy()
+    step = 1
+    while step < len(A):
+        b[step:] = A[step:] @ b[:-step] + b[step:]
+        A[step:] = A[step:] @ A[:-step]
+        step *= 2
+
+    return b
+
+
+def kalman_rts(t, z, model='cv', q=0.1, r=2.5):
+    '''
+    Kalman filter followed by a Rauch-Tung-Striebel backward pass
+
+    t are the timestamps (n) and z the measured positions (n x d). Each axis is filtered independently with the same motion model.
+    Since only positions are measured, covariances and gains are the same for all axes and don't depend on the measurements,
+    see covariances. Given the gains, the filtered and the smoothed states are both linear recursions, which are solved for all
+    samples at once with affine_scan.
+
+    Returns the smoothed states (n x s x d), where the first state is the position
+    '''
+
+    num, dim = z.shape
+    F, Q = motion_model(np.diff(t), model, q)
+    s = F.shape[1]
+
+    # Initial state from the first measurement with uninformative derivatives
+    P_pred, P_filt = covariances(F, Q, np.diag([r] + [1e6]*(s-1)), r)
+    gain = P_pred[:,:,0] / (P_pred[:,0,0,None] + r)
+
+    # Forward pass: x_filt[k] = (I - gain[k] e1^T) F[k-1] x_filt[k-1] + gain[k] z[k]
+    # The first state is the first measurement, since the innovation of the initial state is zero
+    A = np.zeros((num,s,s))
+    A[1:] = F - np.einsum('ki,kj->kij', gain[1:], F[:,0])
+    b = np.einsum('ki,kd->kid', gain, z)
+    b[0], b[0,0] = 0, z[0]
+    x_filt = affine_scan(A, b)
+
+    # Backward pass: x_smooth[k] = C[k] x_smooth[k+1] + (I - C[k] F[k]) x_filt[k], with C[k] = P_filt[k] F[k]^T P_pred[k+1]^-1
+    C = np.swapaxes(np.linalg.solve(P_pred[1:], F @ P_filt[:-1]), 1, 2)
+    A = np.zeros((num,s,s))
+    A[1:] = C[::-1]
+    b = x_filt[::-1].copy()
+    b[1:] -= (C @ F @ x_filt[:-1])[::-1]
+    x_smooth = affine_scan(A, b)[::-1]
+
+    return x_smooth
+
+
+def smooth_trajectory(traj, model='cv', q=0.1, r=2.5):
+    '''
+    Smooth a discrete 3D trajectory whose rows are timestamp, x, y, z
+
+    Returns the smoothed trajectory in the same format
+    '''
+
+    if traj.shape[1] < 2:
+        return traj.copy()
+
+    x_smooth = kalman_rts(traj[0], traj[1:].T, model=model, q=q, r=r)
+
+    return np.vstack((traj[0], x_smooth[:,0].T))
+
+
+def smooth_from_settings(traj, settings):
+    '''
+    Smooth a discrete 3D trajectory with the Kalman settings of a config file
+    '''
+
+    return smooth_trajectory(traj, model=settings.get('kalman_model', 'cv'),
+                             q=settings.get('kalman_process_noise', 0.1),
+                             r=settings.get('kalman_measurement_noise', 2.5))
@@ -54,6 +54,46 @@ def rotation_decompose(R):
 def homogeneous(x):
     return np.vstack((x,np.ones(x.shape[1])))
 
+
+def rodrigues(r):
+    '''
+    Convert rotation vectors into rotation matrices, the vectorized version of cv2.Rodrigues
+
+    Input is an array of shape (N,3), output is an array of shape (N,3,3)
+    '''
+
+    r = np.asarray(r, dtype=float).reshape(-1,3)
+    theta = np.linalg.norm(r, axis=1)
+    small = theta < 1e-12
+    k = r / np.where(small, 1, theta)[:,None]
+
+    c, s = np.cos(theta)[:,None,None], np.sin(theta)[:,None,None]
+    k_cross = np.zeros((len(r),3,3))
+    k_cross[:,0,1], k_cross[:,0,2], k_cross[:,1,2] = -k[:,2], k[:,1], -k[:,0]
+    k_cross -= k_cross.transpose(0,2,1)
+
+    R = c*np.eye(3) + (1-c)*k[:,:,None]*k[:,None,:] + s*k_cross
+    R[small] = np.eye(3)
+    return R
+
+
+def project(P, X):
+    '''
+    Project 3D points with one or more camera matrices
+
+    P is a camera matrix (3,4) or a stack of them (N,3,4). X contains 3D points (3,M), either in
+    euclidean or homogeneous coordinates, or a stack of them (N,3,M) that is projected pairwise.
+
+    Output are homogeneous 2D points normalized to the last coordinate
+    '''
+
+    if X.shape[-2] == 4:
+        x = np.matmul(P, X)
+    else:
+        x = np.matmul(P[...,:3], X) + P[...,3:]
+    x /= x[...,2:,:]
+    return x
+
 # @jit
 def find_intervals(x,gap=5,idx=False):
     '''
@@ -86,6 +126,43 @@ def find_intervals(x,gap=5,idx=False):
     else:
         return interval
 
+
+def lsq_spline(u,x,spacing,k=3):
+    '''
+    Least-squares B-spline fit of points x (d x n) at parameters u, with knots on a fixed grid
+
+    Interior knots are the multiples of spacing inside the range of u, so they don't move when the range of u changes.
+    Knots inside a gap of the points are dropped, so that the gap is bridged by a single knot span. If there are
+    fewer points than coefficients, or the fit is singular, the grid is coarsened to multiples of 2*spacing,
+    4*spacing and so on. The ends are clamped and the fit is a single linear solve.
+
+    Output has the same format as tck of scipy.interpolate.splprep
+    '''
+
+    u = np.asarray(u, dtype=float)
+    k = min(k, len(u)-1)
+
+    while True:
+        grid = np.arange(np.ceil(u[0]/spacing), np.floor(u[-1]/spacing)+1) * spacing
+        grid = grid[(grid>u[0]) & (grid<u[-1])]
+
+        # Drop knots inside gaps of the points, i.e. with empty spans on both sides, so that a gap is a single span
+        count = np.diff(np.concatenate(([0], np.searchsorted(u, grid), [len(u)])))
+        interior = grid[(count[:-1] > 0) | (count[1:] > 0)]
+
+        if len(interior)+k+1 <= len(u):
+            t = np.concatenate(([u[0]]*(k+1), interior, [u[-1]]*(k+1)))
+            try:
+                spl = interpolate.make_lsq_spline(u, x.T, t, k=k)
+                break
+            except (ValueError, np.linalg.LinAlgError):
+                if not len(interior):
+                    raise
+        spacing *= 2
+
+    return [t, [c.copy() for c in spl.c.T], k]
+
+
 # @jit
 def sampling(x,interval,belong=False):
     '''
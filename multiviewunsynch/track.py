@@ -0,0 +1,62 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Replay the detections of a flight through the online tracker and measure its latency and throughput
+#
+# Usage: python track.py <config.json> [<calibrated result>]
+# The calibrated result defaults to the output path of the config
+
+import numpy as np
+import sys
+import time
+from reconstruction import common
+from reconstruction.tracking import Tracker
+
+if len(sys.argv) < 2:
+    print( "Please provide a path to a proper config file")
+    sys.exit()
+
+# Raw detections of the flight
+flight = common.create_scene(sys.argv[1])
+
+# Calibrated rig from a previous reconstruction
+path_result = sys.argv[2] if len(sys.argv) > 2 else flight.settings['path_output']
+rig = common.load_scene(path_result)
+
+tracker = Tracker(rig, window=flight.settings.get('track_window', 1), buffer_size=flight.settings.get('track_buffer', 32))
+
+# Detections of all calibrated cameras in arrival order, approximated by their global timestamps
+stream = []
+for i in rig.sequence:
+    detect = flight.detections[i]
+    timestamp = rig.alpha[i] * detect[0] + rig.beta[i]
+    stream.append(np.vstack((timestamp, np.full(detect.shape[1], i), detect)))
+stream = np.hstack(stream)
+stream = stream[:,np.argsort(stream[0], kind='stable')]
+
+# Replay
+latency = np.zeros(stream.shape[1])
+traj = []
+start = time.perf_counter()
+for k, (_, cam_id, frame, x, y) in enumerate(stream.T):
+    t0 = time.perf_counter()
+    out = tracker.add_detection(int(cam_id), frame, x, y)
+    latency[k] = time.perf_counter() - t0
+    if out is not None:
+        traj.append(np.append(out[0], out[1]))
+total = time.perf_counter() - start
+traj = np.array(traj).T
+
+print('{} detections, {} positions'.format(stream.shape[1], traj.shape[1] if len(traj) else 0))
+print('Throughput: {:.0f} detections/s'.format(stream.shape[1] / total))
+print('Latency: mean {:.3f} ms, median {:.3f} ms, 99% {:.3f} ms, max {:.3f} ms'.format(
+      *(np.array([np.mean(latency), np.median(latency), np.percentile(latency, 99), np.max(latency)]) * 1e3)))
+
+# Compare with the offline reconstruction
+if len(traj) and len(rig.spline['tck']):
+    _, idx = np.unique(traj[0], return_index=True)
+    online = traj[:,idx]
+    offline = rig.sample_spline(online[0])
+    online = online[:,np.isin(online[0], offline[0])]
+    print('Mean distance to the offline trajectory: {:.3g}'.format(np.mean(np.linalg.norm(online[1:] - offline[1:], axis=0))))